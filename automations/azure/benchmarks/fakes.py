@@ -0,0 +1,571 @@
+"""Local stand-ins for the ARM, Key Vault, cClear-V and cVu-V APIs used by the function.
+
+A single HTTP server answers for every host. `redirect_https()` points all of
+the function's HTTPS traffic (our own sessions and the Azure SDK's) at it and
+passes the original host name in a header, so the server can tell ARM, Key
+Vault, the cClear-V and each cVu-V apart.
+"""
+import base64
+import collections
+import hashlib
+import http.server
+import json
+import math
+import random
+import re
+import threading
+import time
+import typing
+import urllib.parse
+
+import requests.adapters
+
+arm_host = "management.azure.com"
+vault_host = "cpacket-benchmark.vault.azure.net"
+secret_name = "cpacket"
+host_header = "X-Fake-Host"
+
+subscription_id = "00000000-0000-0000-0000-000000000000"
+resource_group = "cpacket-benchmark"
+scale_set = "cvuv-vmss"
+cclearv_ip = "10.255.0.4"
+
+
+def cclearv_ips(count: int) -> typing.List[str]:
+    return [f"10.255.0.{4 + index}" for index in range(count)]
+
+
+def cclearv_nic_id(index: int) -> str:
+    return (
+        f"/subscriptions/{subscription_id}/resourceGroups/{resource_group}"
+        f"/providers/Microsoft.Network/networkInterfaces/cclearv-nic{index}"
+    )
+
+
+class Faults(typing.NamedTuple):
+    # Seconds added to every response, and the fraction of requests answered
+    # with a 503.
+    latency: float = 0.0
+    failure_rate: float = 0.0
+
+
+class Cvuv(typing.NamedTuple):
+    ip: str
+    vm_id: str
+
+
+class RegisteredCvuv(typing.NamedTuple):
+    ip: str
+    name: str
+    metrics: bool
+
+
+def scale_set_vm_id(instance_id: int) -> str:
+    return (
+        f"/subscriptions/{subscription_id}/resourceGroups/{resource_group}"
+        f"/providers/Microsoft.Compute/virtualMachineScaleSets/{scale_set}"
+        f"/virtualMachines/{instance_id}"
+    )
+
+
+def cvuv_ip(index: int) -> str:
+    return f"10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}"
+
+
+class FakeCloud:
+    def __init__(
+        self,
+        arm: Faults = Faults(),
+        cclearv: Faults = Faults(),
+        cvuv: Faults = Faults(),
+        page_size: int = 100,
+        seed: int = 0,
+        diag_devices: bool = True,
+        arm_quota: int = 0,
+        arm_quota_window: float = 10.0,
+        cclearvs: int = 1,
+    ):
+        self.faults = {"arm": arm, "vault": arm, "cclearv": cclearv, "cvuv": cvuv}
+        # ARM requests allowed per window (0 for no limit). Responses report the
+        # rest in x-ms-ratelimit-remaining-subscription-reads; beyond it ARM
+        # answers 429 with a Retry-After.
+        self.arm_quota = arm_quota
+        self.arm_quota_window = arm_quota_window
+        self.arm_window_start = time.monotonic()
+        self.arm_used = 0
+        # The appliance password: the appliances answer 401 to any other, and
+        # the fake Key Vault holds it as `secret_name`.
+        self.password = "benchmark"
+        # Whether the cClear-V has the /diag/devices/ API (and /cvu/metrics_config).
+        self.diag_devices = diag_devices
+        self.page_size = page_size
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.cvuvs: typing.List[Cvuv] = []
+        # The cClear-Vs in the resource group, and the devices registered with
+        # each, by device ID.
+        self.cclearv_ips = cclearv_ips(max(cclearvs, 1))
+        self.registries: typing.Dict[str, typing.Dict[str, RegisteredCvuv]] = {
+            ip: {} for ip in self.cclearv_ips
+        }
+        self.requests: typing.Counter[str] = collections.Counter()
+        self.failures: typing.Counter[str] = collections.Counter()
+        self.throttled = 0
+        self.next_oid = 0
+        # Bumped by populate(), so the scale set looks changed to sweeps.
+        self.generation = 0
+        # Set by delete_scale_set(): ARM answers 404 for the scale set.
+        self.scale_set_deleted = False
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.server.cloud = self  # type: ignore[attr-defined]
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def start(self) -> "FakeCloud":
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    # Every device registered with any of the cClear-Vs.
+    @property
+    def registry(self) -> typing.Dict[str, RegisteredCvuv]:
+        return {
+            oid: device
+            for registry in self.registries.values()
+            for oid, device in registry.items()
+        }
+
+    # A scale set of `size` cVu-Vs. `registered` of them are already known to
+    # the first cClear-V, and `stale` devices that left the scale set are still
+    # registered with it. With several cClear-Vs, the pre-registered cVu-Vs
+    # assigned to the others have to move.
+    def populate(self, size: int, registered: float = 0.0, stale: float = 0.0):
+        with self.lock:
+            self.cvuvs = [Cvuv(cvuv_ip(i), scale_set_vm_id(i)) for i in range(size)]
+            self.registries = {ip: {} for ip in self.cclearv_ips}
+            self.requests.clear()
+            self.failures.clear()
+            self.throttled = 0
+            self.generation += 1
+            self.scale_set_deleted = False
+            for cvuv in self.cvuvs[: int(size * registered)]:
+                self.add_device(cclearv_ip, cvuv.ip, registered_name(cvuv.vm_id), True)
+            for i in range(size, size + int(size * stale)):
+                self.add_device(cclearv_ip, cvuv_ip(i), f"cvuv-stale{i}", True)
+
+    # Deletes the scale set and its instances. Their registrations are left for
+    # the function to remove.
+    def delete_scale_set(self) -> None:
+        with self.lock:
+            self.cvuvs = []
+            self.scale_set_deleted = True
+            self.generation += 1
+
+    def add_device(self, cclearv: str, ip: str, name: str, metrics: bool) -> str:
+        self.next_oid += 1
+        oid = f"{self.next_oid:024x}"
+        self.registries[cclearv][oid] = RegisteredCvuv(ip, name, metrics)
+        return oid
+
+    # Takes one ARM request from the budget. Returns the requests left, or the
+    # seconds until the budget refills if there are none.
+    def take_arm_request(self) -> typing.Tuple[int, float]:
+        now = time.monotonic()
+        if now - self.arm_window_start >= self.arm_quota_window:
+            self.arm_window_start = now
+            self.arm_used = 0
+        if self.arm_used >= self.arm_quota:
+            self.throttled += 1
+            return 0, self.arm_window_start + self.arm_quota_window - now
+        self.arm_used += 1
+        return self.arm_quota - self.arm_used, 0.0
+
+    def alive(self, ip: str) -> bool:
+        return ip in self.registries or any(cvuv.ip == ip for cvuv in self.cvuvs)
+
+
+def registered_name(vm_id: str) -> str:
+    # Mirrors cpacketappliances.cvuv_name() so pre-registered devices match.
+    return f"cvuv-{hashlib.sha1(vm_id.encode('utf-8')).hexdigest()[0:6]}"
+
+
+# (service, method, path pattern, phase)
+routes = [
+    ("arm", "GET", r"/subscriptions", "subscriptions"),
+    ("arm", "POST", r"/providers/Microsoft\.ResourceGraph/resources", "lookup"),
+    ("arm", "GET", r"/.*/networkInterfaces/cclearv-nic\d+", "lookup"),
+    (
+        "arm",
+        "GET",
+        r"/subscriptions/[^/]+/resourceGroups/[^/]+/providers/Microsoft\.Compute/virtualMachines",
+        "lookup",
+    ),
+    ("arm", "GET", r"/.*/virtualMachineScaleSets/.*/networkInterfaces", "inventory"),
+    ("vault", "GET", r"/secrets/[^/]+/?", "vault"),
+    ("cclearv", "GET", r"/cfg/debug/dump/", "registry"),
+    ("cclearv", "GET", r"/diag/devices/", "registry"),
+    ("cclearv", "GET", r"/cfg/metrics_config", "registry"),
+    ("cclearv", "POST", r"/rt/data/cvu/modify", "register"),
+    ("cclearv", "POST", r"/rt/data/devauth/modify", "auth"),
+    ("cclearv", "POST", r"/(cfg|cvu)/metrics_config", "metrics"),
+    ("cclearv", "POST", r"/rt/data/cvu/delete", "cleanup"),
+    ("cvuv", "PATCH", r"/admin-api/2022/system_settings", "influx"),
+]
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately; with Nagle's algorithm the body
+    # waits for a delayed ACK and every response gains ~40ms.
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_PATCH(self):
+        self.dispatch("PATCH")
+
+    def log_message(self, format, *args):
+        pass
+
+    def dispatch(self, method: str) -> None:
+        cloud: FakeCloud = self.server.cloud  # type: ignore[attr-defined]
+        host = self.headers.get(host_header, "")
+        if host == arm_host:
+            service = "arm"
+        elif host == vault_host:
+            service = "vault"
+        elif host in cloud.registries:
+            service = "cclearv"
+        else:
+            service = "cvuv"
+        self.host = host
+        url = urllib.parse.urlsplit(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+
+        for route_service, route_method, pattern, phase in routes:
+            if (route_service, route_method) == (service, method) and re.fullmatch(
+                pattern, url.path, flags=re.IGNORECASE
+            ):
+                break
+        else:
+            phase = None
+        if phase is None or (
+            not cloud.diag_devices
+            and url.path in ("/diag/devices/", "/cvu/metrics_config")
+        ):
+            self.reply(404, {"name": "NotFound", "message": f"{method} {url.path}"})
+            return
+
+        authorization = self.headers.get("Authorization", "")
+        if service == "vault" and not authorization.startswith("Bearer "):
+            # The Key Vault client authenticates only once challenged.
+            self.reply(
+                401,
+                {"error": {"code": "Unauthorized", "message": "challenge"}},
+                {
+                    "WWW-Authenticate": 'Bearer authorization="https://login.microsoftonline.com/'
+                    f'{subscription_id}", resource="https://vault.azure.net"'
+                },
+            )
+            return
+        if service in ("cclearv", "cvuv"):
+            with cloud.lock:
+                expected = "Basic " + base64.b64encode(
+                    f"cpacket:{cloud.password}".encode("latin1")
+                ).decode("ascii")
+            if authorization != expected:
+                self.reply(401, {"name": "Unauthorized", "message": "bad password"})
+                return
+
+        headers = {}
+        if service == "arm" and cloud.arm_quota > 0:
+            with cloud.lock:
+                remaining, retry_after = cloud.take_arm_request()
+            if retry_after > 0:
+                self.reply(
+                    429,
+                    {"name": "TooManyRequests", "message": "quota exhausted"},
+                    {"Retry-After": str(math.ceil(retry_after))},
+                )
+                return
+            headers["x-ms-ratelimit-remaining-subscription-reads"] = str(remaining)
+
+        faults = cloud.faults[service]
+        with cloud.lock:
+            cloud.requests[phase] += 1
+            failed = cloud.random.random() < faults.failure_rate
+            if failed:
+                cloud.failures[phase] += 1
+        if faults.latency > 0:
+            time.sleep(faults.latency)
+        if failed:
+            self.reply(
+                503, {"name": "ServiceUnavailable", "message": "injected"}, headers
+            )
+            return
+
+        handler = getattr(self, f"{service}_{phase}")
+        with cloud.lock:
+            status, payload = handler(cloud, url, body)
+        self.reply(status, payload, headers)
+
+    def reply(
+        self,
+        status: int,
+        payload: typing.Any,
+        headers: typing.Mapping[str, str] = {},
+    ) -> None:
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    # ARM
+
+    def arm_subscriptions(self, cloud, url, body):
+        return 200, {
+            "value": [
+                {
+                    "id": f"/subscriptions/{subscription_id}",
+                    "subscriptionId": subscription_id,
+                    "displayName": "benchmark",
+                    "state": "Enabled",
+                }
+            ]
+        }
+
+    def arm_lookup(self, cloud, url, body):
+        if url.path.lower().startswith("/providers/") and "scalesets" in body["query"]:
+            if cloud.scale_set_deleted:
+                return 200, {"totalRecords": 0, "count": 0, "data": []}
+            return 200, {
+                "totalRecords": 1,
+                "count": 1,
+                "data": [
+                    {
+                        "id": f"/subscriptions/{subscription_id}/resourceGroups/{resource_group}"
+                        f"/providers/Microsoft.Compute/virtualMachineScaleSets/{scale_set}",
+                        "name": scale_set,
+                        "resourceGroup": resource_group,
+                        "subscriptionId": subscription_id,
+                        "capacity": str(len(cloud.cvuvs)),
+                        "state": "Succeeded",
+                        "uniqueId": f"fake-{cloud.generation}",
+                    }
+                ],
+            }
+        if url.path.lower().startswith("/providers/"):
+            vms = [
+                {
+                    "id": f"/subscriptions/{subscription_id}/resourceGroups/{resource_group}"
+                    f"/providers/Microsoft.Compute/virtualMachines/cclearv{index}",
+                    "name": f"cclearv{index}",
+                    "nic": cclearv_nic_id(index),
+                }
+                for index in range(len(cloud.cclearv_ips))
+            ]
+            return 200, {"totalRecords": len(vms), "count": len(vms), "data": vms}
+        if url.path.lower().endswith("/virtualmachines"):
+            # CCLEARV_LOOKUP_BACKEND=list: every VM of the resource group, only
+            # the cClear-Vs tagged as such.
+            vms = [
+                {
+                    "id": f"/subscriptions/{subscription_id}/resourceGroups/{resource_group}"
+                    f"/providers/Microsoft.Compute/virtualMachines/{name}",
+                    "name": name,
+                    "location": "eastus",
+                    "tags": tags,
+                    "properties": {
+                        "networkProfile": {"networkInterfaces": [{"id": nic_id}]}
+                    },
+                }
+                for name, tags, nic_id in [
+                    (
+                        f"cclearv{index}",
+                        {"cpacket:ApplianceType": "cClear-V"},
+                        cclearv_nic_id(index),
+                    )
+                    for index in range(len(cloud.cclearv_ips))
+                ]
+                + [("bastion", {}, cclearv_nic_id(len(cloud.cclearv_ips)))]
+            ]
+            return 200, {"value": vms}
+        index = int(re.search(r"cclearv-nic(\d+)$", url.path).group(1))
+        return 200, {
+            "id": cclearv_nic_id(index),
+            "name": f"cclearv-nic{index}",
+            "properties": {
+                "ipConfigurations": [
+                    {
+                        "name": "ipconfig1",
+                        "properties": {"privateIPAddress": cloud.cclearv_ips[index]},
+                    }
+                ]
+            },
+        }
+
+    def arm_inventory(self, cloud, url, body):
+        if cloud.scale_set_deleted:
+            return 404, {
+                "error": {
+                    "code": "ResourceNotFound",
+                    "message": f"The Resource '{scale_set}' was not found.",
+                }
+            }
+        query = urllib.parse.parse_qs(url.query)
+        start = int(query.get("$skiptoken", ["0"])[0])
+        instance = re.search(r"/virtualMachines/(\d+)/", url.path)
+        cvuvs = cloud.cvuvs
+        if instance is not None:
+            cvuvs = [c for c in cvuvs if c.vm_id.endswith(f"/{instance.group(1)}")]
+        page = cvuvs[start : start + cloud.page_size]
+        result: typing.Dict[str, typing.Any] = {"value": []}
+        for cvuv in page:
+            result["value"].append(management_nic(cvuv))
+            result["value"].append(capture_nic(cvuv))
+        if start + cloud.page_size < len(cvuvs):
+            next_query = urllib.parse.urlencode(
+                {
+                    "api-version": query["api-version"][0],
+                    "$skiptoken": start + cloud.page_size,
+                }
+            )
+            result["nextLink"] = f"https://{arm_host}{url.path}?{next_query}"
+        return 200, result
+
+    # Key Vault
+
+    def vault_vault(self, cloud, url, body):
+        name = url.path.strip("/").split("/")[1]
+        if name != secret_name:
+            return 404, {"error": {"code": "SecretNotFound", "message": name}}
+        return 200, {
+            "value": cloud.password,
+            "id": f"https://{vault_host}/secrets/{name}/{cloud.generation:032x}",
+            "attributes": {"enabled": True},
+        }
+
+    # cClear-V
+
+    def cclearv_registry(self, cloud, url, body):
+        registry = cloud.registries[self.host]
+        if url.path == "/cfg/debug/dump/":
+            return 200, {
+                "get_device_info": {
+                    device.name: {"devurl": f"https://{device.ip}"}
+                    for device in registry.values()
+                }
+            }
+        if url.path == "/diag/devices/":
+            return 200, {
+                "cvu": [
+                    {"_id": oid, "ip": device.ip, "name": device.name}
+                    for oid, device in registry.items()
+                ]
+            }
+        return 200, {
+            "data": {
+                "metrics": [
+                    {"category": "cvu", "deviceName": device.name, "deviceOid": oid}
+                    for oid, device in registry.items()
+                    if device.metrics
+                ]
+            }
+        }
+
+    def cclearv_register(self, cloud, url, body):
+        oid = cloud.add_device(self.host, body["ip"], body["name"], False)
+        return 200, {"_id": oid}
+
+    def cclearv_auth(self, cloud, url, body):
+        registry = cloud.registries[self.host]
+        if body["devId"] not in registry:
+            return 404, {"name": "NotFound", "message": body["devId"]}
+        return 200, {}
+
+    def cclearv_metrics(self, cloud, url, body):
+        registry = cloud.registries[self.host]
+        oid = body["device_oid"]
+        if oid not in registry:
+            return 404, {"name": "NotFound", "message": oid}
+        registry[oid] = registry[oid]._replace(metrics=True)
+        return 200, {}
+
+    def cclearv_cleanup(self, cloud, url, body):
+        registry = cloud.registries[self.host]
+        for oid in body["_ids"]:
+            registry.pop(oid, None)
+        return 200, {}
+
+    # cVu-V
+
+    def cvuv_influx(self, cloud, url, body):
+        return 200, {}
+
+
+def management_nic(cvuv: Cvuv) -> typing.Dict[str, typing.Any]:
+    return {
+        "properties": {
+            "ipConfigurations": [{"properties": {"privateIPAddress": cvuv.ip}}],
+            "virtualMachine": {"id": cvuv.vm_id},
+        }
+    }
+
+
+def capture_nic(cvuv: Cvuv) -> typing.Dict[str, typing.Any]:
+    return {
+        "properties": {
+            "ipConfigurations": [
+                {
+                    "properties": {
+                        "privateIPAddress": cvuv.ip.replace("10.", "172.", 1),
+                        "loadBalancerBackendAddressPools": [{"id": "pool"}],
+                    }
+                }
+            ],
+            "virtualMachine": {"id": cvuv.vm_id},
+        }
+    }
+
+
+def redirect_https(port: int) -> None:
+    # Every requests adapter (ours and the one inside azure-core) ends up in
+    # HTTPAdapter.send, so rewriting the URL there catches all traffic.
+    send = requests.adapters.HTTPAdapter.send
+
+    def redirected_send(self, request, *args, **kwargs):
+        url = urllib.parse.urlsplit(request.url)
+        if url.scheme == "https":
+            request = request.copy()
+            request.headers[host_header] = url.hostname
+            request.url = url._replace(
+                scheme="http", netloc=f"127.0.0.1:{port}"
+            ).geturl()
+        return send(self, request, *args, **kwargs)
+
+    requests.adapters.HTTPAdapter.send = redirected_send
+
+
+class FakeCredential:
+    def get_token(self, *scopes, **kwargs):
+        import azure.core.credentials
+
+        return azure.core.credentials.AccessToken("fake-token", int(time.time()) + 3600)
+
+    def close(self) -> None:
+        pass
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""Times the cVu-V synchronization planner on synthetic fleets.
+
+Usage: python plan_benchmark.py [--app DIR] [--sizes 10,100,...] [--repeat N]
+"""
+import argparse
+import importlib.util
+import os
+import random
+import time
+import typing
+
+here = os.path.dirname(os.path.abspath(__file__))
+default_app = os.path.join(here, "..", "registerappliances")
+
+
+def load_planning(app: str) -> typing.Any:
+    # The planner has no dependencies, so it is loaded on its own rather than
+    # through the function package (which needs the Azure SDK).
+    path = os.path.join(app, "cpacketappliances", "planning.py")
+    spec = importlib.util.spec_from_file_location("planning", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# A fleet where most cVu-Vs are registered, some are new, some were removed
+# from the scale set and a few reuse the IP address of a removed one.
+def synthetic_fleet(
+    planning: typing.Any, size: int, seed: int = 0
+) -> typing.Tuple[typing.List[typing.Tuple[str, str, str]], typing.List[typing.Any]]:
+    rng = random.Random(seed)
+    inventory = []
+    registry = []
+    for i in range(size):
+        ip = f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}"
+        name = f"cvuv-{i:06x}"
+        roll = rng.random()
+        if roll < 0.05:
+            registry.append(planning.RegisteredCvuv(ip, name, f"oid-{i}"))
+            continue
+        inventory.append((ip, name, str(i)))
+        if roll < 0.85:
+            registry.append(planning.RegisteredCvuv(ip, name, f"oid-{i}"))
+        elif roll < 0.87:
+            # The removed instance's name, as the function generated it.
+            old_name = f"cvuv-{i ^ 0xFFFFFF:06x}"
+            registry.append(planning.RegisteredCvuv(ip, old_name, f"oid-{i}"))
+    return inventory, registry
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--app", default=default_app, help="function app directory")
+    parser.add_argument("--sizes", default="10,100,1000,10000,100000")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    planning = load_planning(args.app)
+    print(
+        f"{'devices':>8} {'best ms':>10} {'ns/device':>10} "
+        f"{'register':>9} {'repair':>7} {'remove':>7} {'noop':>8}"
+    )
+    for size in [int(size) for size in args.sizes.split(",")]:
+        inventory, registry = synthetic_fleet(planning, size)
+        best = float("inf")
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            plan = planning.plan(inventory, registry)
+            best = min(best, time.perf_counter() - started)
+        print(
+            f"{size:>8} {best * 1000:>10.3f} {best * 1e9 / size:>10.0f} "
+            f"{len(plan.register):>9} {len(plan.repair):>7} "
+            f"{len(plan.remove):>7} {len(plan.noop):>8}"
+        )
+
+
+if __name__ == "__main__":
+    main()
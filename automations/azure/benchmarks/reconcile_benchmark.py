@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""Times cpacketappliances.main end to end against local fake ARM, cClear-V and cVu-V APIs.
+
+Usage: python reconcile_benchmark.py [--app DIR] [--sizes 10,50,...] [--repeat N]
+       [--trigger event|sweep] [--cclearvs N] [--key-vault]
+"""
+import argparse
+import collections
+import datetime
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import types
+import typing
+import uuid
+
+import fakes
+
+here = os.path.dirname(os.path.abspath(__file__))
+default_app = os.path.join(here, "..", "registerappliances")
+
+phases = [
+    "subscriptions",
+    "vault",
+    "lookup",
+    "inventory",
+    "registry",
+    "register",
+    "auth",
+    "metrics",
+    "influx",
+    "cleanup",
+]
+
+# Fraction of the scale set already registered, and of stale registrations, per
+# scenario. In `deleted`, the registered scale set is then deleted.
+scenarios = {
+    "scale-out": (0.0, 0.0),
+    "steady": (1.0, 0.0),
+    "mixed": (0.8, 0.1),
+    "deleted": (1.0, 0.0),
+}
+
+
+def load_app(app: str, cloud: fakes.FakeCloud) -> typing.Any:
+    os.environ.setdefault("APPLIANCE_HTTP_BASIC_AUTH_PASSWORD", "benchmark")
+    os.environ.setdefault("EVENT_COALESCE_WINDOW", "0")
+    os.environ.setdefault(
+        "SWEEP_SQLITE_PATH",
+        os.path.join(tempfile.mkdtemp(prefix="sweep-benchmark"), "sweep.db"),
+    )
+    # Phase timings are read back from the in-memory telemetry sink.
+    os.environ["TELEMETRY_SINK"] = "memory"
+    sys.path.insert(0, os.path.abspath(app))
+    import azure.identity
+
+    import cpacketappliances
+
+    fakes.redirect_https(cloud.port)
+    azure.identity.ManagedIdentityCredential = fakes.FakeCredential
+
+    def probe(ip: str, connect_timeout: float, read_timeout: float):
+        time.sleep(cloud.faults["cvuv"].latency)
+        return None if cloud.alive(ip) else "connection failed: no route to host"
+
+    cpacketappliances.liveness.probe = probe
+    return cpacketappliances
+
+
+def scale_set_event(operation: str) -> typing.Any:
+    import azure.functions as func
+
+    subject = (
+        f"/subscriptions/{fakes.subscription_id}/resourceGroups/{fakes.resource_group}"
+        f"/providers/Microsoft.Compute/virtualMachineScaleSets/{fakes.scale_set}"
+    )
+    return func.EventGridEvent(
+        id=str(uuid.uuid4()),
+        data={"operationName": operation},
+        topic=f"/subscriptions/{fakes.subscription_id}",
+        subject=subject,
+        event_type="Microsoft.Resources.ResourceWriteSuccess",
+        event_time=datetime.datetime.now(datetime.timezone.utc),
+        data_version="",
+    )
+
+
+def invocation_context() -> typing.Any:
+    return types.SimpleNamespace(
+        invocation_id=str(uuid.uuid4()), thread_local_storage=threading.local()
+    )
+
+
+def percentile(samples: typing.List[float], fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run(
+    app: typing.Any,
+    cloud: fakes.FakeCloud,
+    size: int,
+    scenario: str,
+    trigger: str = "event",
+) -> typing.Tuple[float, bool]:
+    registered, stale = scenarios[scenario]
+    cloud.populate(size, registered, stale)
+    operation = "Microsoft.Compute/virtualMachineScaleSets/write"
+    if scenario == "deleted":
+        cloud.delete_scale_set()
+        operation = "Microsoft.Compute/virtualMachineScaleSets/delete"
+    started = time.perf_counter()
+    if trigger == "sweep":
+        import azure.functions.timer
+
+        app.sweep_main(azure.functions.timer.TimerRequest(), invocation_context())
+    else:
+        app.main(scale_set_event(operation), invocation_context())
+    elapsed = time.perf_counter() - started
+    # Without injected failures every cVu-V should end up registered with
+    # metrics enabled, with a single cClear-V, and nothing else.
+    expected = sorted(cvuv.ip for cvuv in cloud.cvuvs)
+    actual = sorted(d.ip for d in cloud.registry.values() if d.metrics)
+    return elapsed, expected == actual
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--app", default=default_app, help="function app directory")
+    parser.add_argument("--sizes", default="10,50,200")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--scenarios", default=",".join(scenarios))
+    parser.add_argument("--arm-latency", type=float, default=50, help="ms")
+    parser.add_argument("--cclearv-latency", type=float, default=20, help="ms")
+    parser.add_argument("--cvuv-latency", type=float, default=20, help="ms")
+    parser.add_argument("--arm-failures", type=float, default=0.0, help="0..1")
+    parser.add_argument("--cclearv-failures", type=float, default=0.0, help="0..1")
+    parser.add_argument("--cvuv-failures", type=float, default=0.0, help="0..1")
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument(
+        "--arm-quota",
+        type=int,
+        default=0,
+        help="ARM requests allowed per --arm-quota-window seconds (0: no limit)",
+    )
+    parser.add_argument("--arm-quota-window", type=float, default=10.0)
+    parser.add_argument(
+        "--cclearv-api",
+        choices=["diag-devices", "debug-dump"],
+        default="diag-devices",
+        help="newest cVu-V inventory API the fake cClear-V has",
+    )
+    parser.add_argument(
+        "--key-vault",
+        action="store_true",
+        help="read the appliance password from the fake Key Vault",
+    )
+    parser.add_argument(
+        "--cclearvs",
+        type=int,
+        default=1,
+        help="cClear-Vs sharing the scale set (pre-registered cVu-Vs start on the first)",
+    )
+    parser.add_argument(
+        "--trigger",
+        choices=["event", "sweep"],
+        default="event",
+        help="reconcile on a scale set event or in a timer-triggered sweep",
+    )
+    parser.add_argument("--verbose", action="store_true", help="show function logs")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+    if args.key_vault:
+        os.environ["APPLIANCE_KEY_VAULT_URL"] = f"https://{fakes.vault_host}"
+    cloud = fakes.FakeCloud(
+        arm=fakes.Faults(args.arm_latency / 1000, args.arm_failures),
+        cclearv=fakes.Faults(args.cclearv_latency / 1000, args.cclearv_failures),
+        cvuv=fakes.Faults(args.cvuv_latency / 1000, args.cvuv_failures),
+        page_size=args.page_size,
+        diag_devices=args.cclearv_api == "diag-devices",
+        arm_quota=args.arm_quota,
+        arm_quota_window=args.arm_quota_window,
+        cclearvs=args.cclearvs,
+    ).start()
+    app = load_app(args.app, cloud)
+    selected_scenarios = args.scenarios.split(",")
+    if args.trigger == "sweep" and "deleted" in selected_scenarios:
+        # Sweeps only see the scale sets that exist: a deleted one is only
+        # handled by its delete event.
+        selected_scenarios.remove("deleted")
+
+    print(
+        f"{'devices':>8} {'scenario':>10} {'first ms':>9} {'p50 ms':>9} "
+        f"{'p99 ms':>9} {'synced':>7}  requests per run by phase"
+    )
+    try:
+        for size in [int(size) for size in args.sizes.split(",")]:
+            for scenario in selected_scenarios:
+                samples = []
+                synced = 0
+                requests: typing.Counter[str] = collections.Counter()
+                phase_ms: typing.Counter[str] = collections.Counter()
+                failures: typing.Counter[str] = collections.Counter()
+                throttled = 0
+                # The first run of each fleet size is reported on its own: on
+                # the very first one the worker is cold and builds its clients
+                # and looks up the cClear-V.
+                first, ok = run(app, cloud, size, scenario, args.trigger)
+                sink = app.telemetry.get_sink()
+                sink.clear()
+                for _ in range(args.repeat):
+                    elapsed, ok = run(app, cloud, size, scenario, args.trigger)
+                    samples.append(elapsed)
+                    synced += ok
+                    requests.update(cloud.requests)
+                    failures.update(cloud.failures)
+                    throttled += cloud.throttled
+                    for metric in sink.find(app.telemetry.phase_duration):
+                        phase_ms[metric.dimensions["phase"]] += metric.total
+                    sink.clear()
+                breakdown = " ".join(
+                    f"{phase}={requests[phase] / args.repeat:.3g}"
+                    + (
+                        f"({failures[phase] / args.repeat:.3g} failed)"
+                        if failures[phase]
+                        else ""
+                    )
+                    for phase in phases
+                    if requests[phase]
+                )
+                if throttled:
+                    breakdown += f" throttled={throttled / args.repeat:.3g}"
+                print(
+                    f"{size:>8} {scenario:>10} {first * 1000:>9.1f} "
+                    f"{percentile(samples, 0.5) * 1000:>9.1f} "
+                    f"{percentile(samples, 0.99) * 1000:>9.1f} "
+                    f"{synced:>3}/{args.repeat:<3}  {breakdown}"
+                )
+                print(
+                    f"{'':>20} mean ms per phase: "
+                    + " ".join(
+                        f"{phase}={total / args.repeat:.1f}"
+                        for phase, total in phase_ms.items()
+                    )
+                )
+    finally:
+        cloud.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""Measures the cold start of the function: package import and first events.
+
+Usage: python startup_benchmark.py [--app DIR] [--repeat N]
+
+Each run is a fresh interpreter, like a new Function App worker.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import typing
+
+here = os.path.dirname(os.path.abspath(__file__))
+default_app = os.path.join(here, "..", "registerappliances")
+
+metrics = ["import", "ignored event", "first reconcile"]
+
+
+def sdk_modules() -> typing.List[str]:
+    # azure.functions is loaded by the worker itself, whatever the function does.
+    return sorted(
+        name
+        for name in sys.modules
+        if name.startswith("azure.")
+        and name.count(".") == 1
+        and name != "azure.functions"
+    )
+
+
+def child(app: str, size: int) -> None:
+    os.environ.setdefault("APPLIANCE_HTTP_BASIC_AUTH_PASSWORD", "benchmark")
+    sys.path.insert(0, os.path.abspath(app))
+    import azure.functions  # noqa: F401  (already loaded by the worker)
+
+    started = time.perf_counter()
+    import cpacketappliances
+
+    result: typing.Dict[str, typing.Any] = {
+        "import": time.perf_counter() - started,
+        "modules after import": sdk_modules(),
+    }
+
+    import fakes
+    import reconcile_benchmark
+
+    cloud = fakes.FakeCloud().start()
+    fakes.redirect_https(cloud.port)
+    cloud.populate(size)
+    cpacketappliances.liveness.probe = lambda ip, connect, read: None
+
+    event = reconcile_benchmark.scale_set_event(
+        "Microsoft.Compute/virtualMachines/write"
+    )
+    started = time.perf_counter()
+    cpacketappliances.main(event, reconcile_benchmark.invocation_context())
+    result["ignored event"] = time.perf_counter() - started
+    result["modules after ignored event"] = sdk_modules()
+
+    import azure.identity
+
+    azure.identity.ManagedIdentityCredential = fakes.FakeCredential
+    event = reconcile_benchmark.scale_set_event(
+        "Microsoft.Compute/virtualMachineScaleSets/write"
+    )
+    started = time.perf_counter()
+    cpacketappliances.main(event, reconcile_benchmark.invocation_context())
+    result["first reconcile"] = time.perf_counter() - started
+    cloud.stop()
+    print(json.dumps(result))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--app", default=default_app, help="function app directory")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--size", type=int, default=10, help="cVu-Vs in the scale set")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.app, args.size)
+        return
+
+    runs = []
+    for _ in range(args.repeat):
+        output = subprocess.run(
+            [sys.executable, __file__, "--child", "--app", args.app]
+            + ["--size", str(args.size)],
+            check=True,
+            capture_output=True,
+            text=True,
+            cwd=here,
+        ).stdout
+        runs.append(json.loads(output.splitlines()[-1]))
+
+    print(f"{'':>16} {'median ms':>10} {'max ms':>10}")
+    for metric in metrics:
+        samples = [run[metric] * 1000 for run in runs]
+        print(f"{metric:>16} {statistics.median(samples):>10.1f} {max(samples):>10.1f}")
+    for loaded in ["modules after import", "modules after ignored event"]:
+        print(f"Azure SDK {loaded}: {', '.join(runs[-1][loaded]) or 'none'}")
+
+
+if __name__ == "__main__":
+    main()
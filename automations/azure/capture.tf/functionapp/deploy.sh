@@ -3,19 +3,25 @@ set -e
 set -x
 
 resource_group="${RESOURCE_GROUP:?Missing RESOURCE_GROUP env var}"
-# The function app and its single function will have the same name.
 function_name="${FUNCTION_NAME:?Missing FUNCTION_NAME env var}"
+# The app also has a timer-triggered function (sweepappliances); only this one
+# receives the Event Grid events.
+event_function_name="cpacketappliances"
 event_grid_system_topic_name="${EVENT_GRID_TOPIC_NAME:?Missing EVENT_GRID_TOPIC_NAME env var}"
 event_grid_system_topic_subscription_name="scaling"
 
 # The location of the Event Grid system topic must be global because of an Azure bug.
 # location="eastus2"
 
+# The function code is shared with manual deployments and lives in
+# automations/azure/registerappliances.
+app_dir="$(cd "$(dirname "$0")/../../registerappliances" && pwd)"
+
 # Publish the function app code.
 # Wait until the Function app is ready...
 count=0
 while true; do
-  if func azure functionapp publish "${function_name}" --python; then
+  if (cd "$app_dir" && func azure functionapp publish "${function_name}" --python); then
     break
   fi
   echo "Waiting for function app '$function_name' to be publishable..."
@@ -31,7 +37,7 @@ done
 count=0
 while true; do
   set +e
-  function_id="$(az functionapp function list -g "$resource_group" -n "$function_name" --query '[0].id' --output tsv)"
+  function_id="$(az functionapp function list -g "$resource_group" -n "$function_name" --query "[?name=='${function_name}/${event_function_name}'].id | [0]" --output tsv)"
   set -e
   if [[ "$function_id" != "" ]]; then
     break
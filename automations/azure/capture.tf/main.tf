@@ -609,6 +609,42 @@ resource "azurerm_service_plan" "this" {
   sku_name = "EP1" # Required for the Function App to talk to the vnet (and the appliances)
 }
 
+# Holds the appliance password, so it is not kept in the Function App's
+# settings. The function reads it with its managed identity and caches it.
+# Key Vault names are limited to 24 characters, so it is named after a hash of
+# the function's name.
+resource "azurerm_key_vault" "this" {
+  name                = local.key_vault_name
+  resource_group_name = azurerm_resource_group.rg.name
+  location            = azurerm_resource_group.rg.location
+  tenant_id           = data.azurerm_client_config.current.tenant_id
+  sku_name            = "standard"
+}
+
+resource "azurerm_key_vault_access_policy" "deployer" {
+  key_vault_id       = azurerm_key_vault.this.id
+  tenant_id          = data.azurerm_client_config.current.tenant_id
+  object_id          = data.azurerm_client_config.current.object_id
+  secret_permissions = ["Get", "List", "Set", "Delete", "Purge"]
+}
+
+resource "azurerm_key_vault_secret" "appliance_password" {
+  name         = "cpacket"
+  value        = var.web_password
+  key_vault_id = azurerm_key_vault.this.id
+
+  depends_on = [
+    azurerm_key_vault_access_policy.deployer
+  ]
+}
+
+resource "azurerm_key_vault_access_policy" "functionapp" {
+  key_vault_id       = azurerm_key_vault.this.id
+  tenant_id          = data.azurerm_client_config.current.tenant_id
+  object_id          = azurerm_linux_function_app.this.identity[0].principal_id
+  secret_permissions = ["Get"]
+}
+
 resource "azurerm_linux_function_app" "this" {
   name                = local.registration_function_name
   resource_group_name = azurerm_resource_group.rg.name
@@ -620,10 +656,15 @@ resource "azurerm_linux_function_app" "this" {
   virtual_network_subnet_id  = azurerm_subnet.functions.id
 
   app_settings = {
-    FUNCTIONS_WORKER_RUNTIME           = "python"
-    WEBSITE_RUN_FROM_PACKAGE           = "0"
-    APPLIANCE_HTTP_BASIC_AUTH_PASSWORD = var.web_password
-    APPINSIGHTS_INSTRUMENTATIONKEY     = azurerm_application_insights.this.instrumentation_key
+    FUNCTIONS_WORKER_RUNTIME       = "python"
+    WEBSITE_RUN_FROM_PACKAGE       = "0"
+    APPLIANCE_KEY_VAULT_URL        = azurerm_key_vault.this.vault_uri
+    APPINSIGHTS_INSTRUMENTATIONKEY = azurerm_application_insights.this.instrumentation_key
+    EVENT_COALESCE_WINDOW          = var.event_coalesce_window
+    EVENT_COALESCE_STORE           = "table"
+    TELEMETRY_SINK                 = "log"
+    SWEEP_STORE                    = "table"
+    REGISTRATION_CHECKPOINT_STORE  = "table"
   }
 
   site_config {
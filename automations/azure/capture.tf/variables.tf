@@ -19,6 +19,12 @@ variable "event_grid_topic_name" {
   default = "rgevents"
 }
 
+variable "event_coalesce_window" {
+  description = "Seconds the registration function waits for further scaling events on a scale set before reconciling it"
+  type        = number
+  default     = 10
+}
+
 variable "functionapp_name" {
   description = "Name of the function"
   default     = "register"
@@ -49,6 +55,7 @@ variable "key_pair" {
 locals {
   deployment_id              = var.deployment_id != "" ? var.deployment_id : "${random_pet.deployment_id.id}"
   registration_function_name = format("%s%s", var.functionapp_name, replace(local.deployment_id, "-", ""))
+  key_vault_name             = format("cpacket-%s", substr(sha1(local.registration_function_name), 0, 16))
   created_by                 = trimsuffix(regex(".*@", data.azuread_user.current_user.user_principal_name), "@")
   label                      = var.label != "" ? var.label : local.created_by
   cpacket_resource_tags = {
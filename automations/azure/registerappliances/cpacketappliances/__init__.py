@@ -1,28 +1,103 @@
 import azure.functions as func
+import base64
+import collections
+import concurrent.futures
+import functools
 import logging
 import json
 import requests
 import hashlib
-import re
+import itertools
 import os
-
-import azure.functions as func
-import azure.keyvault.secrets
-import azure.core.credentials
-import azure.identity
-import azure.mgmt.compute
-import azure.mgmt.subscription
-import azure.mgmt.network
+import sys
+import threading
+import time
+import urllib.parse
 import typing
 
+from . import (
+    checkpoints,
+    clients,
+    coalescing,
+    credentials,
+    discovery,
+    inventory,
+    liveness,
+    logs,
+    planning,
+    resilience,
+    sessions,
+    sharding,
+    sweeping,
+    telemetry,
+    throttling,
+    tokens,
+)
+from .settings import get_env_int
+
+# The Azure SDK packages take seconds to import on a cold worker, so they are
+# only imported (by the clients module) once an event needs them.
+if typing.TYPE_CHECKING:
+    import azure.core.credentials
+    import azure.mgmt.compute
+
 appliance_type_key = "cpacket:ApplianceType"
 appliance_type_value = "cClear-V"
-key_vault_name = "cpacket"
 appliance_username = "cpacket"
 
+# Registration stages, in the order each cVu-V goes through them.
+stage_register = "register"
+stage_auth = "auth"
+stage_metrics = "metrics"
+stage_influx = "influx"
+
+
+# Number of cVu-Vs registered concurrently; 1 runs the pipelines serially.
+registration_workers = get_env_int("CVUV_REGISTRATION_WORKERS", 8)
+# Maximum number of device IDs sent to cClear-V in a single removal request.
+cclearv_batch_size = get_env_int("CCLEARV_BATCH_SIZE", 100)
+# How the cClear-V VMs are found: "resourcegraph" filters on their tag server side,
+# "list" lists every VM in the resource group and filters them here.
+vm_lookup_backend = os.environ.get("CCLEARV_LOOKUP_BACKEND", "resourcegraph")
+
+
+def main(event: func.EventGridEvent, context: func.Context):
+    invoke("total", functools.partial(reconcile, event, context))
+
+
+# Entry point of the timer-triggered function (see sweepappliances/).
+def sweep_main(timer: func.TimerRequest, context: func.Context):
+    if timer.past_due:
+        logging.info("sweep is running late")
+    invoke("sweep", functools.partial(sweep, context))
+
 
-def main(event: func.EventGridEvent):
-    result = json.dumps(
+def invoke(phase: str, work: typing.Callable[[], None]) -> None:
+    pool_stats_before = sessions.pool_stats()
+    try:
+        with telemetry.phase(phase):
+            work()
+    except Exception as e:
+        if is_authentication_error(e):
+            clients.invalidate(f"authentication failed: {e}")
+        raise
+    finally:
+        sessions.log_pool_stats(pool_stats_before)
+        telemetry.flush()
+
+
+# Without importing azure.core: if it was never loaded, no SDK call was made.
+def is_authentication_error(error: Exception) -> bool:
+    exceptions = sys.modules.get("azure.core.exceptions")
+    return exceptions is not None and isinstance(
+        error, exceptions.ClientAuthenticationError
+    )
+
+
+def reconcile(event: func.EventGridEvent, context: func.Context):
+    logs.payload(
+        "event",
+        "event",
         {
             "id": event.id,
             "data": event.get_json(),
@@ -30,202 +105,791 @@ def main(event: func.EventGridEvent):
             "subject": event.subject,
             "event_type": event.event_type,
         },
-        indent=4,
-        sort_keys=True,
     )
-
-    logging.info("%s", result)
     operation_name = event.get_json()["operationName"]
 
     if operation_name == "Microsoft.Compute/virtualMachineScaleSets/write":
-        logging.info(f"handling scaling operation: {operation_name}")
+        logging.info(f"handling scale out operation: {operation_name}")
     elif operation_name == "Microsoft.Compute/virtualMachineScaleSets/delete":
-        logging.info(f"handling VMSS machine delete: {operation_name}")
+        logging.info(f"handling scale in operation: {operation_name}")
+    elif operation_name in (
+        "Microsoft.Compute/virtualMachineScaleSets/virtualMachines/write",
+        "Microsoft.Compute/virtualMachineScaleSets/virtualMachines/delete",
+    ):
+        logging.info(f"handling instance operation: {operation_name}")
+        if reconcile_instance(context, event.subject, operation_name):
+            return
+        logging.info("falling back to reconciling the whole scale set")
     else:
         logging.info(f"ignoring operation: {operation_name}")
         return
 
-    scale_set_name = event.subject.split("/")[-1]
-    resource_group_name = event.subject.split("/")[-5]
+    # Instance-level subjects carry /virtualMachines/<instance ID> after the
+    # scale set name.
+    scale_set_subject = "/".join(event.subject.split("/")[:9])
+    subscription_id = scale_set_subject.split("/")[2]
+    scale_set_name = scale_set_subject.split("/")[-1]
+    resource_group_name = scale_set_subject.split("/")[-5]
     logging.info(
         f"scale_set_name: {scale_set_name}, resource_group_name: {resource_group_name}"
     )
 
-    creds = azure.identity.ManagedIdentityCredential()
-
-    subscription_id = get_subscription_id(creds)
-    if subscription_id is None:
+    if coalescing.coalesce(scale_set_subject) is None:
         return
 
-    compute_client = azure.mgmt.compute.ComputeManagementClient(
-        creds, subscription_id=subscription_id
+    reconcile_scale_set(context, subscription_id, resource_group_name, scale_set_name)
+
+
+# Checks every scale set next to a cClear-V, in every subscription the managed
+# identity can see, and reconciles those that changed since the last sweep, so
+# that changes whose events were lost are caught up. Returns the outcome of each
+# reconciled scale set, keyed by resource ID.
+def sweep(context: func.Context) -> typing.Dict[str, str]:
+    with telemetry.phase("clients"):
+        subscription_ids = clients.get_subscription_ids()
+    if subscription_ids is None:
+        return {}
+
+    with telemetry.phase("sweep_lookup"):
+        scale_sets = query_cvuv_scale_sets(
+            clients.get_credential().get_token(tokens.management_scope),
+            subscription_ids,
+        )
+    if scale_sets is None:
+        return {}
+
+    selected = sweeping.select(scale_sets, sweeping.get_store().load(), time.time())
+    outcomes = sweeping.fan_out(selected, functools.partial(sweep_scale_set, context))
+    sweeping.log_outcomes(selected, outcomes)
+    return outcomes
+
+
+def sweep_scale_set(context: func.Context, scale_set: sweeping.ScaleSet) -> str:
+    attach_invocation_context(context)
+    logging.info(
+        f"sweeping scale_set_name: {scale_set.name}, resource_group_name: {scale_set.resource_group}, "
+        f"subscription: {scale_set.subscription_id}"
     )
-    network_client = azure.mgmt.network.NetworkManagementClient(
-        creds, subscription_id=subscription_id
+    started = time.time()
+    try:
+        in_sync = reconcile_scale_set(
+            context,
+            scale_set.subscription_id,
+            scale_set.resource_group,
+            scale_set.name,
+            max_changes=sweeping.sweep_max_changes,
+        )
+    except Exception as e:
+        if is_authentication_error(e):
+            raise
+        logging.error(f"failed to sweep {scale_set.name}, unknown Exception: {e}")
+        return sweeping.outcome_failed
+    # A scale set that is not fully in sync is retried by the next sweep.
+    if not in_sync:
+        return sweeping.outcome_incomplete
+    sweeping.record(scale_set, started)
+    return sweeping.outcome_in_sync
+
+
+# Returns True if the cClear-V registry matched the scale set once done.
+def reconcile_scale_set(
+    context: typing.Optional[func.Context],
+    subscription_id: str,
+    resource_group_name: str,
+    scale_set_name: str,
+    max_changes: typing.Optional[int] = None,
+) -> bool:
+    with telemetry.phase("clients"):
+        azure_clients = clients.get_clients(subscription_id)
+    if azure_clients is None:
+        return False
+    # Aborts before any change if the appliance password cannot be read.
+    get_cpacket_credentials()
+
+    # The scale set is listed while the cClear-Vs are found and their
+    # registries read.
+    discovered = discovery.run_graph(
+        {
+            "inventory": discovery.Step(
+                lambda: list_cvuv_devices(
+                    azure_clients, resource_group_name, scale_set_name
+                )
+            ),
+            "cclearv_lookup": discovery.Step(
+                lambda: get_cclearv_ip_addresses(azure_clients, resource_group_name)
+            ),
+            "registry": discovery.Step(
+                functools.partial(get_cvuv_registries, context),
+                after=("cclearv_lookup",),
+            ),
+        },
+        initializer=functools.partial(attach_invocation_context, context),
     )
 
-    cvuv_devices = get_cvuv_ip_addresses(
-        creds.get_token("https://management.core.windows.net//.default"),
-        subscription_id,
-        resource_group_name,
-        scale_set_name,
+    cvuv_devices, complete_inventory = discovered["inventory"]
+    if not complete_inventory:
+        # Registered cVu-Vs missing from a partial listing are kept, and the
+        # scale set is not in sync until it is listed in full.
+        logging.error(
+            f"listed {len(cvuv_devices)} cVu-Vs of {scale_set_name} before the listing failed"
+        )
+    elif len(cvuv_devices) == 0:
+        # Every registered cVu-V is then stale, and removed once unreachable.
+        logging.info(f"no cVu-Vs found in {scale_set_name}")
+
+    cclearv_ip_addresses = discovered["cclearv_lookup"]
+    if cclearv_ip_addresses is None:
+        return False
+
+    logging.info(f"cClear-V IP addresses: {','.join(cclearv_ip_addresses)}")
+    cvuv_registries = discovered["registry"]
+    if len(cvuv_registries) == 0:
+        return False
+
+    # The cVu-Vs assigned to a cClear-V whose registry could not be read are
+    # left for a later run.
+    with telemetry.phase("plan"):
+        cvuv_plans = planning.plan_shards(
+            cvuv_devices,
+            cvuv_registries,
+            sharding.Ring(cclearv_ip_addresses).owner,
+            complete_inventory,
+        )
+    deferred = 0
+    if max_changes is not None:
+        for cclearv_ip, cvuv_plan in cvuv_plans.items():
+            cvuv_plans[cclearv_ip], shard_deferred = planning.limit(
+                cvuv_plan, max_changes
+            )
+            max_changes -= len(cvuv_plans[cclearv_ip].register) + len(
+                cvuv_plans[cclearv_ip].repair
+            )
+            deferred += shard_deferred
+        if deferred > 0:
+            logging.info(f"deferring {deferred} cVu-Vs to a later run")
+
+    failed = execute_shards(context, cvuv_plans, cvuv_registries)
+    return (
+        complete_inventory
+        and len(failed) == 0
+        and deferred == 0
+        and len(cvuv_registries) == len(cclearv_ip_addresses)
     )
 
-    if len(cvuv_devices) == 0:
-        logging.info(f"no cVu-Vs found in {scale_set_name}")
 
-    cclearv_ip_address = get_cclearv_ip_address(
-        compute_client=compute_client,
-        network_client=network_client,
-        resource_group_name=resource_group_name,
+# Executes each cClear-V's plan, then removes the cVu-Vs that moved to another
+# cClear-V from the one they were registered with, once the new one has them
+# set up. Returns the IP addresses of the cVu-Vs that failed.
+def execute_shards(
+    context: typing.Optional[func.Context],
+    cvuv_plans: typing.Dict[str, planning.Plan],
+    cvuv_registries: typing.Dict[str, typing.List[planning.RegisteredCvuv]],
+) -> typing.Set[str]:
+    failed: typing.Set[str] = set()
+    settled: typing.Set[str] = set()
+    for cclearv_ip, cvuv_plan in cvuv_plans.items():
+        shard_failed = execute_plan(
+            context, cclearv_ip, cvuv_plan, cvuv_registries[cclearv_ip]
+        )
+        failed |= shard_failed
+        settled.update(
+            device.ip
+            for device in itertools.chain(
+                cvuv_plan.register, cvuv_plan.repair, cvuv_plan.noop
+            )
+            if device.ip not in shard_failed
+        )
+
+    with telemetry.phase("cleanup"):
+        for cclearv_ip, cvuv_plan in cvuv_plans.items():
+            remove_moved_cvuvs(
+                cclearv_ip,
+                [device for device in cvuv_plan.moved if device.ip in settled],
+            )
+    return failed
+
+
+# Returns the IP addresses of the cVu-Vs whose registration or repair failed.
+def execute_plan(
+    context: typing.Optional[func.Context],
+    cclearv_ip: str,
+    cvuv_plan: planning.Plan,
+    cvuv_registry: typing.List[planning.RegisteredCvuv],
+) -> typing.Set[str]:
+    logging.info(
+        f"synchronization plan for {cclearv_ip}: {len(cvuv_plan.register)} to register, "
+        f"{len(cvuv_plan.repair)} to repair, {len(cvuv_plan.remove)} to test for removal, "
+        f"{len(cvuv_plan.moved)} moved to another cClear-V, "
+        f"{len(cvuv_plan.noop)} already registered"
+    )
+    logs.payload(
+        "plan",
+        "already registered with cClear-V",
+        [device.ip for device in cvuv_plan.noop],
     )
 
-    logging.info(f"cClear-V IP address: {cclearv_ip_address}")
-    registered_cvuv_devices = list_registered_cvuvs(cclearv_ip_address)
-    if registered_cvuv_devices is None:
-        logging.info(
-            "failed to get registered cVu-V IP addresses: skipping synchronization"
+    # Registered cVu-Vs whose registration stopped part way, on an earlier
+    # event, only go through the stages they have not completed.
+    checkpointed = checkpoints.load(cclearv_ip, cvuv_registry)
+    resumed = [
+        device
+        for device in cvuv_plan.noop
+        if device.ip in checkpointed
+        and checkpointed[device.ip].cvuv_name == device.name
+    ]
+    if len(resumed) > 0:
+        logging.info(f"resuming {len(resumed)} unfinished cVu-V registrations")
+
+    with telemetry.phase("repair"):
+        repaired, repair_failed = remove_renamed_cvuvs(
+            cclearv_ip, cvuv_plan.repair, cvuv_registry
         )
-        return
 
-    if len(registered_cvuv_devices) == 0:
-        logging.info("no existing registered cVu-V IP addresses in cClear-V")
-    else:
+    with telemetry.phase("register"):
+        pipeline_results = run_registration_pipelines(
+            context,
+            itertools.chain(cvuv_plan.register, repaired, resumed),
+            cvuv_pipeline(
+                cclearv_ip, {device.ip: checkpointed[device.ip] for device in resumed}
+            ),
+        )
+    checkpoints.discard(
+        cclearv_ip,
+        [
+            cvuv_ip
+            for cvuv_ip, failed_stage in pipeline_results.items()
+            if failed_stage is None
+        ],
+    )
+    successfully_added_cvuv_ips = [
+        cvuv_ip
+        for cvuv_ip, failed_stage in pipeline_results.items()
+        if failed_stage != stage_register
+    ]
+    logging.info(
+        f"successfully added cvuv_ips: {','.join(successfully_added_cvuv_ips)}"
+    )
+
+    with telemetry.phase("cleanup"):
+        remove_stale_cvuvs(cclearv_ip, cvuv_plan.remove)
+
+    return repair_failed | {
+        cvuv_ip
+        for cvuv_ip, failed_stage in pipeline_results.items()
+        if failed_stage is not None
+    }
+
+
+# A cVu-V whose IP address is registered under another name belongs to a new
+# instance that reused the address. The old registration is removed so the
+# cVu-V can be registered under its own name, after which it matches the
+# registry. Returns the cVu-Vs to register, and the IP addresses of those whose
+# old registration could not be removed.
+def remove_renamed_cvuvs(
+    cclearv_ip: str,
+    renamed_cvuvs: typing.List[planning.InventoryCvuv],
+    cvuv_registry: typing.List[planning.RegisteredCvuv],
+) -> typing.Tuple[typing.List[planning.InventoryCvuv], typing.Set[str]]:
+    if len(renamed_cvuvs) == 0:
+        return [], set()
+
+    registered_by_ip = {device.ip: device for device in cvuv_registry}
+    for device in renamed_cvuvs:
         logging.info(
-            # N.B.: Set() type is not JSON serializable
-            f"registered cVu-V devices before synchronization: {json.dumps(list(registered_cvuv_devices), indent=4, sort_keys=True)}"
+            f"{device.ip} is registered as {registered_by_ip[device.ip].name}: re-registering it as {device.name}"
         )
+    deletion_results = delete_cvuvs_batched(
+        cclearv_ip,
+        [registered_by_ip[device.ip].device_oid for device in renamed_cvuvs],
+    )
+    removed: typing.List[planning.InventoryCvuv] = []
+    failed: typing.Set[str] = set()
+    for device in renamed_cvuvs:
+        if deletion_results.get(registered_by_ip[device.ip].device_oid, False):
+            removed.append(device)
+        else:
+            logging.error(
+                f"failed to remove {device.ip}, registered under another name, from {cclearv_ip}"
+            )
+            failed.add(device.ip)
+    checkpoints.discard(cclearv_ip, [device.ip for device in removed])
+    return removed, failed
+
+
+# Removes the registered cVu-Vs that are no longer in the scale set, unless they
+# still answer.
+def remove_stale_cvuvs(
+    cclearv_ip: str, stale_cvuvs: typing.List[planning.RegisteredCvuv]
+) -> None:
+    if len(stale_cvuvs) == 0:
+        return
+
+    stale_by_ip = {device.ip: device for device in stale_cvuvs}
+    logging.info(f"testing existing cVu-V instances: {','.join(sorted(stale_by_ip))}")
+    unreachable_cvuv_ips = liveness.find_unreachable(stale_by_ip.keys())
+    for ip in stale_by_ip.keys() - unreachable_cvuv_ips.keys():
+        logging.info(f"skipping {ip} removal: apparently, it is still alive")
+
+    deletion_results = delete_cvuvs_batched(
+        cclearv_ip, [stale_by_ip[ip].device_oid for ip in unreachable_cvuv_ips]
+    )
+    removed_ips: typing.List[str] = []
+    for ip, reason in unreachable_cvuv_ips.items():
+        device_oid = stale_by_ip[ip].device_oid
+        if deletion_results.get(device_oid, False):
+            logging.info(
+                f"successfully removed {ip} ({reason}) with device ID {device_oid} from {cclearv_ip}"
+            )
+            removed_ips.append(ip)
+        else:
+            logging.error(
+                f"failed to remove {ip} ({reason}) with device ID {device_oid} from {cclearv_ip}"
+            )
+    checkpoints.discard(cclearv_ip, removed_ips)
+
+
+# Removes cVu-Vs from a cClear-V they are no longer assigned to. They are still
+# in the scale set, so no liveness probe is needed.
+def remove_moved_cvuvs(
+    cclearv_ip: str, moved_cvuvs: typing.List[planning.RegisteredCvuv]
+) -> None:
+    if len(moved_cvuvs) == 0:
+        return
+
+    deletion_results = delete_cvuvs_batched(
+        cclearv_ip, [device.device_oid for device in moved_cvuvs]
+    )
+    removed_ips: typing.List[str] = []
+    for device in moved_cvuvs:
+        if deletion_results.get(device.device_oid, False):
+            logging.info(
+                f"removed {device.ip}, now assigned to another cClear-V, from {cclearv_ip}"
+            )
+            removed_ips.append(device.ip)
+        else:
+            logging.error(
+                f"failed to remove {device.ip}, now assigned to another cClear-V, from {cclearv_ip}"
+            )
+    checkpoints.discard(cclearv_ip, removed_ips)
+
+
+# Registers or removes only the cVu-V named by an instance-level event subject,
+# .../virtualMachineScaleSets/<name>/virtualMachines/<instance ID>. Returns False
+# if the event cannot be handled on its own, in which case the whole scale set
+# is reconciled instead.
+def reconcile_instance(
+    context: func.Context, subject: str, operation_name: str
+) -> bool:
+    parts = subject.split("/")
+    subscription_id = parts[2]
+    resource_group_name = parts[4]
+    scale_set_name = parts[8]
+    instance_id = parts[10]
+    logging.info(
+        f"scale_set_name: {scale_set_name}, resource_group_name: {resource_group_name}, instance_id: {instance_id}"
+    )
+
+    with telemetry.phase("clients"):
+        azure_clients = clients.get_clients(subscription_id)
+    if azure_clients is None:
+        return True
+    get_cpacket_credentials()
+
+    # The instance's cVu-V name is derived from its resource ID, so the
+    # cClear-V it is assigned to can be guessed before its NICs are listed.
+    # ARM may case the subject differently from the NIC's VM reference, which
+    # the name is registered under.
+    name = cvuv_name(subject)
+
+    if operation_name.endswith("/delete"):
+        # The instance and its NICs are gone, so its cVu-V is looked for under
+        # the name derived from the subject, and under the one its NIC gave if
+        # this worker listed it; if neither is registered, the scale set is
+        # reconciled instead. It is removed from whichever cClear-V has it,
+        # which is not necessarily the one it is assigned to now.
+        listed_name = listed_cvuv_name(subject)
+        with telemetry.phase("cclearv_lookup"):
+            cclearv_ip_addresses = get_cclearv_ip_addresses(
+                azure_clients, resource_group_name
+            )
+        if cclearv_ip_addresses is None:
+            return True
+
+        with telemetry.phase("registry"):
+            cvuv_registries = get_cvuv_registries(context, cclearv_ip_addresses)
+        deleted = False
+        for cclearv_ip_address, cvuv_registry in cvuv_registries.items():
+            deleted_cvuvs = [
+                device
+                for device in cvuv_registry
+                if device.name == name or device.name == listed_name
+            ]
+            if len(deleted_cvuvs) == 0:
+                continue
+
+            deleted = True
+            with telemetry.phase("cleanup"):
+                deletion_results = delete_cvuvs_batched(
+                    cclearv_ip_address,
+                    [device.device_oid for device in deleted_cvuvs],
+                )
+            for device in deleted_cvuvs:
+                if deletion_results.get(device.device_oid, False):
+                    logging.info(
+                        f"removed {device.ip} with device ID {device.device_oid} from {cclearv_ip_address}"
+                    )
+                    checkpoints.discard(cclearv_ip_address, [device.ip])
+                else:
+                    logging.error(
+                        f"failed to remove {device.ip} with device ID {device.device_oid} from {cclearv_ip_address}"
+                    )
+        if not deleted:
+            logging.info(f"{name} is not registered with cClear-V")
+        return deleted
+
+    # Only the registry of the cClear-V the instance is assigned to is needed,
+    # and the one its subject is assigned to is read while the NICs are
+    # listed. If the instance was registered with another cClear-V before, the
+    # next reconcile of the scale set moves it.
+    discovered = discovery.run_graph(
+        {
+            "inventory": discovery.Step(
+                lambda: list_cvuv_devices(
+                    azure_clients,
+                    resource_group_name,
+                    scale_set_name,
+                    instance_id=instance_id,
+                )
+            ),
+            "cclearv_lookup": discovery.Step(
+                lambda: get_cclearv_ip_addresses(azure_clients, resource_group_name)
+            ),
+            "registry": discovery.Step(
+                lambda cclearv_ip_addresses: get_cvuv_registry(
+                    context, sharding.Ring(cclearv_ip_addresses).owner(name)
+                ),
+                after=("cclearv_lookup",),
+            ),
+        },
+        initializer=functools.partial(attach_invocation_context, context),
+    )
 
-    cvuv_registry_ips: typing.Dict[str, str] = {
-        device["ip"]: device["_id"] for device in registered_cvuv_devices
+    cvuv_devices, complete_inventory = discovered["inventory"]
+    if len(cvuv_devices) == 0 or not complete_inventory:
+        logging.info(f"no cVu-V found for instance {instance_id} of {scale_set_name}")
+        return False
+
+    cclearv_ip_addresses = discovered["cclearv_lookup"]
+    if cclearv_ip_addresses is None:
+        return True
+
+    # The scale set reconcile assigns the cVu-V by the name its NIC gives.
+    ring = sharding.Ring(cclearv_ip_addresses)
+    cclearv_ip_address = ring.owner(cvuv_devices[0][1])
+    cvuv_registry = discovered["registry"]
+    if cclearv_ip_address != ring.owner(name):
+        with telemetry.phase("registry"):
+            cvuv_registry = get_cvuv_registry(context, cclearv_ip_address)
+    if cvuv_registry is None:
+        return True
+
+    execute_plan(
+        context,
+        cclearv_ip_address,
+        planning.plan(cvuv_devices, cvuv_registry, complete_inventory=False),
+        cvuv_registry,
+    )
+    return True
+
+
+# Returns the cVu-Vs registered with each cClear-V whose registry could be read,
+# keyed by cClear-V IP address. The registries are read concurrently.
+def get_cvuv_registries(
+    context: typing.Optional[func.Context],
+    cclearv_ips: typing.List[str],
+) -> typing.Dict[str, typing.List[planning.RegisteredCvuv]]:
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(len(cclearv_ips), 1),
+        thread_name_prefix="cclearv-registry",
+    ) as executor:
+        cvuv_registries = list(
+            executor.map(functools.partial(get_cvuv_registry, context), cclearv_ips)
+        )
+    return {
+        cclearv_ip: cvuv_registry
+        for cclearv_ip, cvuv_registry in zip(cclearv_ips, cvuv_registries)
+        if cvuv_registry is not None
     }
 
-    # synchronization starts
-    successfully_added_cvuv_ips: typing.Set[str] = set()
 
-    for cvuv_ip, cvuv_id, device_id in cvuv_devices:
-        if cvuv_ip in cvuv_registry_ips:
-            logging.info(f"{cvuv_ip} is already registered with cClear-V")
-            successfully_added_cvuv_ips.add(cvuv_ip)
-            continue
+# Returns the cVu-Vs registered with cClear-V, or None if the registry could not
+# be read.
+def get_cvuv_registry(
+    context: typing.Optional[func.Context],
+    cclearv_ip: str,
+) -> typing.Optional[typing.List[planning.RegisteredCvuv]]:
+    attach_invocation_context(context)
+    cvuv_registry = inventory.read_registry(
+        cclearv_ip, functools.partial(fetch_cclearv_resource, context, cclearv_ip)
+    )
+    if cvuv_registry is None:
+        logging.info(
+            f"failed to get cVu-V IP addresses registered with {cclearv_ip}: skipping its synchronization"
+        )
+        return None
 
+    if len(cvuv_registry) == 0:
+        logging.info(f"no existing registered cVu-V IP addresses in {cclearv_ip}")
+    else:
         logging.info(
-            f"registering {cvuv_ip} with {cclearv_ip_address}: {device_id} {cvuv_id}"
+            f"{len(cvuv_registry)} cVu-Vs registered with {cclearv_ip} before synchronization"
         )
+    return cvuv_registry
+
+
+def cvuv_pipeline(
+    cclearv_ip: str, resumed: typing.Mapping[str, checkpoints.Checkpoint]
+) -> typing.Callable[..., typing.Optional[str]]:
+    cclearv_user, cclearv_password = get_cpacket_credentials()
+    return functools.partial(
+        register_cvuv_pipeline, cclearv_ip, cclearv_user, cclearv_password, resumed
+    )
+
+
+# Runs the registration stages for one cVu-V in order and returns the stage that
+# failed, or None if every stage succeeded. The cVu-V is checkpointed once
+# registered, and again with the stages completed if a later one fails; a cVu-V
+# in `resumed` skips the stages its checkpoint lists. The caller discards the
+# checkpoints of the cVu-Vs that finished.
+def register_cvuv_pipeline(
+    cclearv_ip: str,
+    cclearv_user: str,
+    cclearv_password: str,
+    resumed: typing.Mapping[str, checkpoints.Checkpoint],
+    cvuv_ip: str,
+    cvuv_id: str,
+    device_id: str,
+) -> typing.Optional[str]:
+    checkpoint = resumed.get(cvuv_ip)
+    if checkpoint is None:
+        logging.info(f"registering {cvuv_ip} with {cclearv_ip}")
         add_remove_cvuv_response = register_cvuv(
-            cclearv_ip_address, cvuv_ip, cvuv_id, device_id
+            cclearv_ip, cvuv_ip, cvuv_id, device_id
         )
         if add_remove_cvuv_response is None:
             logging.info(f"skipping {cvuv_ip} registration due to previous error")
-            continue
+            return stage_register
         else:
             logging.info(f"registered {cvuv_ip}")
-            successfully_added_cvuv_ips.add(cvuv_ip)
+        checkpoint = checkpoints.Checkpoint(
+            cvuv_ip=cvuv_ip,
+            cvuv_name=cvuv_id,
+            device_oid=add_remove_cvuv_response["_id"],
+            completed=frozenset([stage_register]),
+        )
+        checkpoints.save(cclearv_ip, checkpoint)
+    else:
+        logging.info(
+            f"resuming {cvuv_ip} registration after {', '.join(sorted(checkpoint.completed))}"
+        )
+    saved = checkpoint
 
-        auth_result = device_auth(cclearv_ip_address, add_remove_cvuv_response["_id"])
+    if stage_auth not in checkpoint.completed:
+        auth_result = device_auth(cclearv_ip, checkpoint.device_oid)
         if auth_result is None:
             logging.info(f"skipping {cvuv_ip} authentication due to previous error")
-            continue
+            return stage_auth
+        checkpoint = checkpoints.complete(checkpoint, stage_auth)
 
+    if stage_metrics not in checkpoint.completed:
         metrics_activation_result = activate_cvuv_metrics(
-            cclearv_ip_address, add_remove_cvuv_response["_id"], cvuv_id
+            cclearv_ip, checkpoint.device_oid, cvuv_id
         )
         if metrics_activation_result is None:
             logging.info(f"skipping {cvuv_ip} metrics activation due to previous error")
-            continue
+            checkpoints.update(cclearv_ip, saved, checkpoint)
+            return stage_metrics
+        checkpoint = checkpoints.complete(checkpoint, stage_metrics)
 
-        configure_influx_result = configure_influx(cvuv_ip, cclearv_ip_address)
-        if configure_influx_result is None:
-            logging.info(
-                f"skipping {cvuv_ip} InfluxDB configuration due to previous error"
+    configure_influx_result = configure_influx(
+        cvuv_ip, cclearv_ip, cclearv_user, cclearv_password
+    )
+    if configure_influx_result is None:
+        logging.info(f"skipping {cvuv_ip} InfluxDB configuration due to previous error")
+        checkpoints.update(cclearv_ip, saved, checkpoint)
+        return stage_influx
+
+    return None
+
+
+# Stages stay in order within a device; different devices run in parallel on at
+# most `registration_workers` threads. Returns the failed stage (or None) keyed by
+# cVu-V IP address.
+def run_registration_pipelines(
+    context: typing.Optional[func.Context],
+    cvuv_devices: typing.Iterable[typing.Tuple[str, str, str]],
+    pipeline: typing.Callable[..., typing.Optional[str]],
+) -> typing.Dict[str, typing.Optional[str]]:
+    results: typing.Dict[str, typing.Optional[str]] = {}
+    if registration_workers <= 1:
+        for cvuv_ip, cvuv_id, device_id in cvuv_devices:
+            results[cvuv_ip] = run_pipeline_safely(
+                pipeline, cvuv_ip, cvuv_id, device_id
             )
-            continue
+        return results
+
+    # Devices are submitted as the iterable yields them. The executor only starts
+    # as many threads as there is work for.
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=registration_workers,
+        thread_name_prefix="cvuv-registration",
+        initializer=attach_invocation_context,
+        initargs=(context,),
+    ) as executor:
+        futures = {
+            executor.submit(
+                run_pipeline_safely, pipeline, cvuv_ip, cvuv_id, device_id
+            ): cvuv_ip
+            for cvuv_ip, cvuv_id, device_id in cvuv_devices
+        }
+        logging.info(
+            f"registering {len(futures)} cVu-Vs with up to {registration_workers} workers"
+        )
+        for future in concurrent.futures.as_completed(futures):
+            results[futures[future]] = future.result()
 
-    logging.info(
-        f"successfully added cvuv_ips: {','.join(successfully_added_cvuv_ips)}"
-    )
+    return results
 
-    registered_cvuv_ips = set(cvuv_registry_ips.keys())
 
-    for ip in registered_cvuv_ips - successfully_added_cvuv_ips:
-        logging.info(f"testing cVu-V {ip}")
-        test_response = test_http(f"https://{ip}/")
-        if test_response is None:
-            try:
-                deletion_result = delete_cvuv(cclearv_ip_address, cvuv_registry_ips[ip])
-                if deletion_result is None:
-                    logging.error(
-                        f"failed to remove {ip} with device ID {cvuv_registry_ips[ip]} from {cclearv_ip_address}"
-                    )
-                else:
-                    logging.info(
-                        f"successfully removed {ip} with device ID {cvuv_registry_ips[ip]} from {cclearv_ip_address}"
-                    )
-            except KeyError as e:
-                logging.error(f"failed to remove {ip}, no device ID: {e}")
-        else:
-            logging.info(f"skipping {ip} removal: apparently, it is still alive")
+def run_pipeline_safely(
+    pipeline: typing.Callable[..., typing.Optional[str]],
+    cvuv_ip: str,
+    cvuv_id: str,
+    device_id: str,
+) -> typing.Optional[str]:
+    with telemetry.span(telemetry.pipeline_duration) as span:
+        try:
+            failed_stage = pipeline(cvuv_ip, cvuv_id, device_id)
+        except Exception as e:
+            logging.error(f"failed {cvuv_ip} registration, unknown Exception: {e}")
+            failed_stage = stage_register
+        span.set(outcome=failed_stage or "ok")
+    return failed_stage
+
 
+def attach_invocation_context(context: typing.Optional[func.Context]) -> None:
+    # Logs emitted from worker threads are only associated with the invocation
+    # (and therefore shipped to Application Insights) if the thread carries the
+    # invocation ID.
+    if context is not None:
+        context.thread_local_storage.invocation_id = context.invocation_id
 
-def get_cclearv_ip_address(
-    compute_client: azure.mgmt.compute.ComputeManagementClient,
-    network_client: azure.mgmt.network.NetworkManagementClient,
+
+# Returns the IP addresses of every cClear-V in the resource group, sorted, or
+# None if any of them could not be found: the cVu-Vs are shared out between all
+# of them, so a partial list would move cVu-Vs away from the missing ones.
+def get_cclearv_ip_addresses(
+    azure_clients: clients.AzureClients,
     resource_group_name: str,
-) -> typing.Optional[str]:
-    cclearv_instance = get_vm_by_tag(
-        compute_client, appliance_type_key, appliance_type_value, resource_group_name
+) -> typing.Optional[typing.List[str]]:
+    return discovery.cached_addresses(
+        azure_clients.subscription_id,
+        resource_group_name,
+        appliance_type_key,
+        appliance_type_value,
+        lambda: lookup_cclearv_ip_addresses(azure_clients, resource_group_name),
+    )
+
+
+def lookup_cclearv_ip_addresses(
+    azure_clients: clients.AzureClients,
+    resource_group_name: str,
+) -> typing.Optional[typing.List[str]]:
+    cclearv_instances = find_vms_by_tag(
+        azure_clients, appliance_type_key, appliance_type_value, resource_group_name
     )
-    if cclearv_instance is None:
+    if cclearv_instances is None:
         logging.error(
             f"Failed to find cClear-V instance with tag {appliance_type_key}={appliance_type_value}: bailing"
         )
-        return
+        return None
 
-    cclearv_ip_address = get_vm_primary_ip_address(
-        cclearv_instance, network_client, resource_group_name
-    )
+    cclearv_ip_addresses = []
+    for cclearv_instance in cclearv_instances:
+        logging.info(f"cClear-V: {cclearv_instance}")
 
-    if cclearv_ip_address is None:
-        logging.error(f"failed to get primary IP address for cClear-V instance")
-        return
+        cclearv_ip_address = get_vm_primary_ip_address(
+            cclearv_instance.primary_nic_id,
+            azure_clients.network_client,
+            resource_group_name,
+        )
+        if cclearv_ip_address is None:
+            logging.error(
+                f"failed to get primary IP address for cClear-V instance {cclearv_instance.name}"
+            )
+            return None
+        cclearv_ip_addresses.append(cclearv_ip_address)
 
-    return cclearv_ip_address
+    return sorted(cclearv_ip_addresses)
 
 
-def delete_cvuv(cclearv_ip: str, cvuv_id: str) -> typing.Optional[typing.Dict]:
+def delete_cvuvs(
+    cclearv_ip: str, cvuv_ids: typing.List[str]
+) -> typing.Optional[typing.Dict]:
     cclearv_url = f"https://{cclearv_ip}/rt/data/cvu/delete"
-    payload = {
-        "_ids": [
-            cvuv_id,
-        ]
-    }
+    payload = {"_ids": cvuv_ids}
     response = send_prepared_request(
         requests.Request(
             "POST", cclearv_url, json=payload, auth=get_cpacket_credentials()
-        ).prepare()
+        ).prepare(),
+        idempotent=True,
     )
     if response is not None:
         return decode_response(response)
     else:
-        logging.error(f"failed removal for {cvuv_id}")
+        logging.error(f"failed removal for {','.join(cvuv_ids)}")
         return None
 
 
+# Removes the devices in batches of `cclearv_batch_size` IDs per request and
+# returns whether each device ID was removed. A failed batch is retried one ID
+# at a time, so a single bad ID does not keep the rest of the batch registered.
+def delete_cvuvs_batched(
+    cclearv_ip: str, cvuv_ids: typing.List[str]
+) -> typing.Dict[str, bool]:
+    results: typing.Dict[str, bool] = {}
+    for batch in chunked(cvuv_ids, cclearv_batch_size):
+        if delete_cvuvs(cclearv_ip, batch) is not None:
+            results.update({cvuv_id: True for cvuv_id in batch})
+            continue
+        if len(batch) == 1:
+            results[batch[0]] = False
+            continue
+        logging.info(f"retrying removal of {len(batch)} devices one at a time")
+        for cvuv_id in batch:
+            results[cvuv_id] = delete_cvuvs(cclearv_ip, [cvuv_id]) is not None
+    return results
+
+
+def chunked(items: typing.List[str], size: int) -> typing.Iterator[typing.List[str]]:
+    size = max(size, 1)
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
 def activate_cvuv_metrics(
     cclearv_ip: str, device_id: str, device_name: str
 ) -> typing.Optional[typing.Dict]:
-    cclearv_url = f"https://{cclearv_ip}/cvu/metrics_config"
-    payload = {
-        "device_oid": device_id,
-        "device_name": device_name,
-        "config": {
-            "collect": True,
-        },
-    }
+    # The endpoint depends on the cClear-V version, found when its registry was
+    # read.
+    adapter = inventory.selected_adapter(cclearv_ip)
+    cclearv_url = f"https://{cclearv_ip}{adapter.metrics_config_path}"
+    payload = adapter.metrics_config_payload(device_id, device_name)
     response = send_prepared_request(
         requests.Request(
             "POST", cclearv_url, json=payload, auth=get_cpacket_credentials()
-        ).prepare()
+        ).prepare(),
+        idempotent=True,
     )
     if response is not None:
         return decode_response(response)
@@ -245,7 +909,8 @@ def device_auth(cclearv_ip: str, device_id: str) -> typing.Optional[typing.Dict]
     response = send_prepared_request(
         requests.Request(
             "POST", cclearv_url, json=payload, auth=get_cpacket_credentials()
-        ).prepare()
+        ).prepare(),
+        idempotent=True,
     )
     if response is not None:
         return decode_response(response)
@@ -254,9 +919,10 @@ def device_auth(cclearv_ip: str, device_id: str) -> typing.Optional[typing.Dict]
         return None
 
 
-def configure_influx(cvuv_ip: str, cclearv_ip: str) -> typing.Optional[typing.Dict]:
+def configure_influx(
+    cvuv_ip: str, cclearv_ip: str, cclearv_user: str, cclearv_password: str
+) -> typing.Optional[typing.Dict]:
     cvuv_url = f"https://{cvuv_ip}/admin-api/2022/system_settings"
-    cclearv_user, cclearv_password = get_cpacket_credentials()
     payload = {
         "stats_db_user": cclearv_user,
         "stats_db_pswd": cclearv_password,
@@ -264,8 +930,9 @@ def configure_influx(cvuv_ip: str, cclearv_ip: str) -> typing.Optional[typing.Di
     }
     response = send_prepared_request(
         requests.Request(
-            "PATCH", cvuv_url, json=payload, auth=(cclearv_user, cclearv_password)
-        ).prepare()
+            "PATCH", cvuv_url, json=payload, auth=get_cpacket_credentials()
+        ).prepare(),
+        idempotent=True,
     )
     if response is not None:
         logging.info(f"successfully configured stats DB for {cvuv_ip}")
@@ -286,7 +953,7 @@ def register_cvuv(
         "verify_ssl": False,
         "deviceId": device_id,
     }
-    logging.info(f"register cVu-V POST payload\n: {json.dumps(payload)}")
+    logs.payload("register", "register cVu-V POST payload", payload)
     response = send_prepared_request(
         requests.Request(
             "POST", cclearv_url, json=payload, auth=get_cpacket_credentials()
@@ -300,87 +967,248 @@ def register_cvuv(
         return None
 
 
-def get_subscription_id(
-    credentials: azure.identity.ManagedIdentityCredential,
-) -> typing.Optional[str]:
-    subscriptions_client = azure.mgmt.subscription.SubscriptionClient(credentials)
-    subscriptions = list(subscriptions_client.subscriptions.list())
-    if len(subscriptions) == 0:
-        logging.error(f"failed to get any subscriptions")
-        return None
-    elif len(subscriptions) > 1:
-        subscription_strings: typing.List[str] = []
-        for sub in subscriptions:
-            if sub is not None and sub.id is not None:
-                subscription_strings.append(sub.id)
-        logging.error(
-            f"multiple subscriptions obtained when only 1 was expected: {','.join(subscription_strings)}"
-        )
-        return None
-
-    return subscriptions[0].subscription_id
+# Raised by vmss_rest_api_list_nics when a page of NICs cannot be read, after
+# the NICs of the pages read before it.
+class IncompleteListing(Exception):
+    pass
 
 
 # https://stackoverflow.com/questions/59613250/get-private-ip-addresses-for-vms-in-a-scale-set-via-python-sdk-no-public-ip-add
 def vmss_rest_api_list_nics(
-    token: azure.core.credentials.AccessToken,
+    token: "azure.core.credentials.AccessToken",
     subscription_id: str,
     resource_group: str,
     vmss_name: str,
-    api_version: str = "2018-10-01",
-) -> typing.Optional[typing.Dict]:
-    url = f"https://management.azure.com/subscriptions/{subscription_id}/resourceGroups/{resource_group}/providers/microsoft.Compute/virtualMachineScaleSets/{vmss_name}/networkInterfaces"
-    params = {"api-version": api_version}
-    request = requests.Request("GET", url, params=params)
+    api_version: str = "2023-09-01",
+    instance_id: typing.Optional[str] = None,
+) -> typing.Iterator[typing.Dict]:
+
+    url = f"https://management.azure.com/subscriptions/{subscription_id}/resourceGroups/{resource_group}/providers/microsoft.Compute/virtualMachineScaleSets/{vmss_name}"
+    if instance_id is not None:
+        url = f"{url}/virtualMachines/{instance_id}"
+    url = f"{url}/networkInterfaces"
+    params: typing.Optional[typing.Dict[str, str]] = {"api-version": api_version}
+    first_page = True
+    while url is not None:
+        request = requests.Request("GET", url, params=params)
+        prepped = request.prepare()
+        prepped.headers["Authorization"] = f"Bearer {token.token}"
+
+        # A scale set (or instance) that was deleted has no NICs left: its
+        # listing is complete and empty, so its cVu-Vs are removed.
+        response = send_prepared_request(
+            prepped, verify=True, accepted_statuses=(404,) if first_page else ()
+        )
+        if response is None:
+            raise IncompleteListing(f"failed to get NICs for {vmss_name}")
+        if response.status_code == 404:
+            logging.info(f"{vmss_name} not found: it has no NICs")
+            return
+        first_page = False
+        page = decode_response(response)
+        if page is None:
+            raise IncompleteListing(f"failed to decode NICs of {vmss_name}")
+
+        yield from page.get("value", [])
+
+        # The next link already carries the API version and continuation token.
+        url = page.get("nextLink")
+        params = None
+
+
+# GETs a cClear-V API for the inventory adapters. A 404 or 405 is passed back
+# rather than logged as an error: it means this cClear-V version lacks the API.
+# Registry reads may fetch from several threads; each keeps the invocation's log
+# context.
+def fetch_cclearv_resource(
+    context: typing.Optional[func.Context], cclearv_ip: str, path: str
+) -> inventory.Response:
+    attach_invocation_context(context)
+    return get_cclearv_resource(cclearv_ip, path)
+
+
+def get_cclearv_resource(cclearv_ip: str, path: str) -> inventory.Response:
+    request = requests.Request(
+        "GET", f"https://{cclearv_ip}{path}", auth=get_cpacket_credentials()
+    )
+    response = send_prepared_request(
+        request.prepare(), accepted_statuses=inventory.unsupported_statuses
+    )
+    if response is None:
+        return inventory.Response(status=None, body=None)
+    if response.status_code in inventory.unsupported_statuses:
+        return inventory.Response(status=response.status_code, body=None)
+    return inventory.Response(
+        status=response.status_code, body=decode_response(response)
+    )
+
+
+def decode_response(response: requests.Response) -> typing.Optional[typing.Dict]:
+    try:
+        return response.json()
+    except requests.exceptions.JSONDecodeError as e:
+        logging.error(f"failed to decode JSON for {response.text}: {e}")
+        return None
+
+
+class TaggedVm(typing.NamedTuple):
+    id: str
+    name: str
+    primary_nic_id: str
+
+
+# Looks the VMs up with the configured backend. Resource Graph evaluates the tag
+# filter server side; listing every VM in the resource group is the fallback,
+# also used when the Resource Graph index has not caught up with a new VM yet.
+def find_vms_by_tag(
+    azure_clients: clients.AzureClients,
+    tag_name: str,
+    tag_value: str,
+    resource_group_name: str,
+) -> typing.Optional[typing.List[TaggedVm]]:
+    if vm_lookup_backend == "resourcegraph":
+        virtual_machines = query_vms_by_tag(
+            azure_clients.credential.get_token(tokens.management_scope),
+            azure_clients.subscription_id,
+            tag_name,
+            tag_value,
+            resource_group_name,
+        )
+        if virtual_machines is not None and len(virtual_machines) > 0:
+            return found_vms(virtual_machines, tag_name, tag_value)
+        logging.info(
+            f"Resource Graph did not find VM with {tag_name}={tag_value}: listing VMs"
+        )
+
+    return get_vms_by_tag(
+        azure_clients.compute_client, tag_name, tag_value, resource_group_name
+    )
+
+
+def query_vms_by_tag(
+    token: "azure.core.credentials.AccessToken",
+    subscription_id: str,
+    tag_name: str,
+    tag_value: str,
+    resource_group_name: str,
+    endpoint: str = "https://management.azure.com",
+    api_version: str = "2021-03-01",
+) -> typing.Optional[typing.List[TaggedVm]]:
+    # json.dumps() quotes and escapes the values as KQL string literals.
+    query = (
+        "Resources"
+        " | where type =~ 'microsoft.compute/virtualmachines'"
+        f" | where resourceGroup =~ {json.dumps(resource_group_name)}"
+        f" | where tags[{json.dumps(tag_name)}] == {json.dumps(tag_value)}"
+        " | project id, name,"
+        " nic = tostring(properties.networkProfile.networkInterfaces[0].id)"
+    )
+    payload = {
+        "subscriptions": [subscription_id],
+        "query": query,
+        "options": {"resultFormat": "objectArray"},
+    }
+    url = f"{endpoint}/providers/Microsoft.ResourceGraph/resources"
+    request = requests.Request(
+        "POST", url, params={"api-version": api_version}, json=payload
+    )
     prepped = request.prepare()
     prepped.headers["Authorization"] = f"Bearer {token.token}"
 
-    response = send_prepared_request(prepped, verify=True)
-    if response is not None:
-        return decode_response(response)
-    else:
+    # A query: safe to repeat although it is a POST.
+    response = send_prepared_request(prepped, verify=True, idempotent=True)
+    if response is None:
+        return None
+    decoded = decode_response(response)
+    if decoded is None or "data" not in decoded:
+        logging.error(f"unexpected Resource Graph response: {decoded}")
         return None
 
+    return [
+        TaggedVm(id=row["id"], name=row["name"], primary_nic_id=row["nic"])
+        for row in decoded["data"]
+    ]
+
+
+# Finds the scale sets in resource groups that have a cClear-V, as the events
+# handled by reconcile() come from such a resource group. One query covers every
+# subscription.
+def query_cvuv_scale_sets(
+    token: "azure.core.credentials.AccessToken",
+    subscription_ids: typing.List[str],
+    endpoint: str = "https://management.azure.com",
+    api_version: str = "2021-03-01",
+) -> typing.Optional[typing.List[sweeping.ScaleSet]]:
+    tag_filter = ""
+    tag = sweeping.scale_set_tag()
+    if tag is not None:
+        tag_filter = f" | where tags[{json.dumps(tag[0])}] == {json.dumps(tag[1])}"
+    query = (
+        "Resources"
+        " | where type =~ 'microsoft.compute/virtualmachinescalesets'"
+        f"{tag_filter}"
+        " | extend group = tolower(strcat(subscriptionId, '/', resourceGroup))"
+        " | join kind=inner (Resources"
+        " | where type =~ 'microsoft.compute/virtualmachines'"
+        f" | where tags[{json.dumps(appliance_type_key)}] == {json.dumps(appliance_type_value)}"
+        " | extend group = tolower(strcat(subscriptionId, '/', resourceGroup))"
+        " | distinct group)"
+        " on group"
+        " | project id, name, resourceGroup, subscriptionId,"
+        " capacity = tostring(sku.capacity),"
+        " state = tostring(properties.provisioningState),"
+        " uniqueId = tostring(properties.uniqueId)"
+    )
+    url = f"{endpoint}/providers/Microsoft.ResourceGraph/resources"
+
+    scale_sets: typing.List[sweeping.ScaleSet] = []
+    skip_token = None
+    while True:
+        options: typing.Dict[str, typing.Any] = {"resultFormat": "objectArray"}
+        if skip_token is not None:
+            options["$skipToken"] = skip_token
+        payload = {
+            "subscriptions": subscription_ids,
+            "query": query,
+            "options": options,
+        }
+        request = requests.Request(
+            "POST", url, params={"api-version": api_version}, json=payload
+        )
+        prepped = request.prepare()
+        prepped.headers["Authorization"] = f"Bearer {token.token}"
 
-def list_registered_cvuvs(
-    cclearv_ip: str,
-) -> typing.Optional[typing.List[typing.Dict]]:
-    cclearv_url = f"https://{cclearv_ip}/diag/devices/"  # note trailing slash
-    request = requests.Request("GET", cclearv_url, auth=get_cpacket_credentials())
-    response = send_prepared_request(request.prepare())
-    if response is not None:
+        response = send_prepared_request(prepped, verify=True, idempotent=True)
+        if response is None:
+            return None
         decoded = decode_response(response)
-        if decoded is None:
+        if decoded is None or "data" not in decoded:
+            logging.error(f"unexpected Resource Graph response: {decoded}")
             return None
-        else:
-            logging.info(f"decoded: {json.dumps(decoded, indent=4, sort_keys=True)}")
-            if "cvu" in decoded:
-                devices = decoded["cvu"]
-                logging.info(
-                    f"devices: {json.dumps(devices, indent=4, sort_keys=True)}"
-                )
-                return devices
-            else:
-                logging.info("no cVu-V devices found in call to `/diag/devices/`")
-                return None
-    else:
-        return None
-
 
-def decode_response(response: requests.Response) -> typing.Optional[typing.Dict]:
-    try:
-        return response.json()
-    except requests.exceptions.JSONDecodeError as e:
-        logging.error(f"failed to decode JSON for {response.text}: {e}")
-        return None
+        for row in decoded["data"]:
+            scale_sets.append(
+                sweeping.ScaleSet(
+                    id=row["id"],
+                    name=row["name"],
+                    resource_group=row["resourceGroup"],
+                    subscription_id=row["subscriptionId"],
+                    marker=f"{row['uniqueId']}:{row['capacity']}:{row['state']}",
+                    provisioning_state=row["state"],
+                )
+            )
+        skip_token = decoded.get("$skipToken")
+        if skip_token is None:
+            return scale_sets
 
 
-def get_vm_by_tag(
-    compute_client: azure.mgmt.compute.ComputeManagementClient,
+def get_vms_by_tag(
+    compute_client: "azure.mgmt.compute.ComputeManagementClient",
     tag_name: str,
     tag_value: str,
     resource_group_name: str,
-) -> typing.Any:
+) -> typing.Optional[typing.List[TaggedVm]]:
+
     virtual_machines = []
     for vm in compute_client.virtual_machines.list(
         resource_group_name=resource_group_name
@@ -390,97 +1218,234 @@ def get_vm_by_tag(
             and tag_name in vm.tags
             and vm.tags[tag_name] == tag_value
         ):
-            virtual_machines.append(vm)
+            virtual_machines.append(
+                TaggedVm(
+                    id=vm.id,
+                    name=vm.name,
+                    primary_nic_id=vm.network_profile.network_interfaces[0].id,
+                )
+            )
+
+    return found_vms(virtual_machines, tag_name, tag_value)
 
+
+def found_vms(
+    virtual_machines: typing.List[TaggedVm], tag_name: str, tag_value: str
+) -> typing.Optional[typing.List[TaggedVm]]:
     if len(virtual_machines) == 0:
         logging.info(f"did not find VM with {tag_name}={tag_value}")
         return None
 
-    if len(virtual_machines) > 1:
-        logging.error(f"found multiple VMs with {tag_name}={tag_value}")
-        return None
-
-    vm = virtual_machines[0]
-    logging.info(f"found VM {vm.name} with {tag_name}: {vm.tags[tag_name]}")
-    return vm
+    for vm in virtual_machines:
+        logging.info(f"found VM {vm.name} with {tag_name}: {tag_value}")
+    return sorted(virtual_machines, key=lambda vm: vm.id.lower())
 
 
+# The password is read from Key Vault (or the app settings) once and cached; see
+# the credentials module. Raises credentials.PasswordUnavailable if it has never
+# been read, so no appliance is sent an empty password.
 def get_cpacket_credentials() -> typing.Tuple[str, str]:
-    password = os.environ["APPLIANCE_HTTP_BASIC_AUTH_PASSWORD"]
+    password = credentials.get_password()
+    if password is None:
+        raise credentials.PasswordUnavailable(
+            f"appliance password unavailable from {credentials.get_secret().source.name}"
+        )
     return (appliance_username, password)
 
 
-def test_http(url: str) -> typing.Optional[str]:
-    logging.info(f"testing existing cVu-V instances: GET {url}")
-    prepped = requests.Request("GET", url).prepare()
-    response = send_prepared_request(prepped)
-    if response is not None:
-        return response.text
-    else:
-        return None
+# cClear-V and the cVu-Vs answer 401 when the appliance password was changed
+# after it was cached. Discards the rejected password and re-signs the request
+# with the current one. Returns True if it differs, so the request is worth
+# sending again.
+def renew_appliance_auth(prepared: requests.PreparedRequest) -> bool:
+    rejected_header = prepared.headers.get("Authorization", "")
+    if not rejected_header.startswith("Basic "):
+        return False
+
+    _, _, rejected = (
+        base64.b64decode(rejected_header[len("Basic ") :])
+        .decode("latin1")
+        .partition(":")
+    )
+    credentials.invalidate(rejected)
+    prepared.prepare_auth(get_cpacket_credentials())
+    return prepared.headers.get("Authorization") != rejected_header
+
+
+# A 401 from ARM means the cached token was revoked or its identity changed, so
+# the cached credential and clients are dropped and the next call fetches anew.
+def discard_rejected_token(prepared: requests.PreparedRequest) -> None:
+    if not prepared.headers.get("Authorization", "").startswith("Bearer "):
+        return
+    if urllib.parse.urlsplit(prepared.url).hostname not in throttling.arm_hosts:
+        return
+    clients.invalidate(f"{prepared.url} rejected the token")
 
 
+# Sends a request, retrying it with backoff if it is idempotent and failed
+# transiently. Requests made through this function count towards the circuit
+# breaker of their host. Callers mark non-GET requests that are safe to repeat
+# with `idempotent=True`.
 def send_prepared_request(
-    prepared: requests.PreparedRequest, verify=False
+    prepared: requests.PreparedRequest,
+    verify=False,
+    accepted_statuses: typing.Container[int] = (),
+    idempotent: typing.Optional[bool] = None,
 ) -> typing.Optional[requests.Response]:
-    with requests.Session() as session:
-        response = requests.Response()
+    if idempotent is None:
+        idempotent = prepared.method in resilience.idempotent_methods
+    attempts = max(resilience.retry_attempts, 1) if idempotent else 1
+    breaker = resilience.breaker_for(prepared.url)
+    governor = throttling.governor_for(prepared.url)
+    endpoint = telemetry.endpoint_name(prepared.url)
+
+    for attempt in range(attempts):
+        if not breaker.allow():
+            resilience.rejected(prepared.url)
+            return None
+        last_attempt = attempt == attempts - 1
+
+        if governor is not None:
+            governor.acquire()
+        response, failure = send_once(prepared, verify, attempt)
+        # A rejected password was not acted on, so even a registration can be
+        # sent again with the new one.
+        if (
+            response is not None
+            and response.status_code == 401
+            and renew_appliance_auth(prepared)
+        ):
+            logging.info(f"retrying {prepared.url} with the new appliance password")
+            response, failure = send_once(prepared, verify, attempt)
+        if response is not None and response.status_code == 401:
+            discard_rejected_token(prepared)
+        if governor is not None and response is not None:
+            governor.observe(response.status_code, response.headers)
+        if response is None:
+            breaker.record_failure()
+            if failure in ("connection_error", "timeout") and not last_attempt:
+                logging.warning(f"retrying {prepared.url} after {failure}")
+                resilience.sleep_before_retry(attempt, endpoint, failure)
+                continue
+            return None
+
+        if response.status_code in resilience.failure_statuses:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+
+        if response.status_code >= 200 and response.status_code < 302:
+            return response
+        if response.status_code in accepted_statuses:
+            return response
+        if response.status_code in resilience.retryable_statuses and not last_attempt:
+            logging.warning(
+                f"retrying {prepared.url} after HTTP {response.status_code}"
+            )
+            resilience.sleep_before_retry(attempt, endpoint, str(response.status_code))
+            continue
+
+        log_error_response(prepared, response)
+        return None
+
+    return None
+
+
+# One attempt at a request. Returns the response, whatever its status, or the
+# kind of failure that prevented getting one.
+def send_once(
+    prepared: requests.PreparedRequest, verify: bool, attempt: int
+) -> typing.Tuple[typing.Optional[requests.Response], typing.Optional[str]]:
+    session = sessions.get_session(verify)
+    with telemetry.http_span(prepared.method, prepared.url) as span:
+        span.set(retries=attempt)
         try:
             response = session.send(prepared, timeout=10, verify=verify)
+            span.set(status=response.status_code)
+            return response, None
         except requests.exceptions.ConnectionError as e:
+            span.set(status="connection_error")
             logging.error(f"network error occurred accessing {prepared.url}: {e}")
-            return None
+            discovery.invalidate_address(urllib.parse.urlsplit(prepared.url).hostname)
+            return None, "connection_error"
         except requests.exceptions.Timeout as e:
+            span.set(status="timeout")
             logging.error(f"timeout occurred accessing {prepared.url}: {e}")
-            return None
+            return None, "timeout"
         except requests.exceptions.TooManyRedirects as e:
+            span.set(status="too_many_redirects")
             logging.error(f"too many redirects occurred accessing {prepared.url}: {e}")
-            return None
+            return None, "too_many_redirects"
         except requests.exceptions.HTTPError as e:
+            span.set(status="http_error")
             logging.error(f"HTTP error occurred accessing {prepared.url}: {e}")
-            return None
+            return None, "http_error"
         except Exception as e:
+            span.set(status="error")
             logging.error(
                 f"failed to communicate with {prepared.url}, unknown Exception: {e}"
             )
-            return None
+            return None, "error"
 
-        if response.status_code >= 200 and response.status_code < 302:
-            return response
 
-        err = decode_response(response)
-        if err is None:
-            return None
+def log_error_response(
+    prepared: requests.PreparedRequest, response: requests.Response
+) -> None:
+    err = decode_response(response)
+    if err is None:
+        return
 
-        try:
-            if "name" in err and "message" in err:
-                logging.error(
-                    f"HTTP {response.status_code} accessing '{prepared.url}' ({err['name']}): {err['message']}"
-                )
-        except KeyError:
+    try:
+        if "name" in err and "message" in err:
             logging.error(
-                f"HTTP {response.status_code} accessing '{prepared.url}': {response.text}"
+                f"HTTP {response.status_code} accessing '{prepared.url}' ({err['name']}): {err['message']}"
             )
+    except KeyError:
+        logging.error(
+            f"HTTP {response.status_code} accessing '{prepared.url}': {response.text}"
+        )
 
-        return None
+
+# Returns the cVu-Vs of a scale set, or of one of its instances, and whether
+# they were all listed. When a page of NICs fails, the cVu-Vs listed before it
+# are returned.
+def list_cvuv_devices(
+    azure_clients: clients.AzureClients,
+    resource_group_name: str,
+    scale_set_name: str,
+    instance_id: typing.Optional[str] = None,
+) -> typing.Tuple[typing.List[typing.Tuple[str, str, str]], bool]:
+    cvuv_devices: typing.List[typing.Tuple[str, str, str]] = []
+    try:
+        for cvuv_device in get_cvuv_ip_addresses(
+            azure_clients.credential.get_token(tokens.management_scope),
+            azure_clients.subscription_id,
+            resource_group_name,
+            scale_set_name,
+            instance_id=instance_id,
+        ):
+            cvuv_devices.append(cvuv_device)
+    except IncompleteListing as e:
+        logging.error(str(e))
+        return cvuv_devices, False
+    return cvuv_devices, True
 
 
 def get_cvuv_ip_addresses(
-    token: azure.core.credentials.AccessToken,
+    token: "azure.core.credentials.AccessToken",
     subscription_id: str,
     resource_group_name: str,
     scale_set_name: str,
-) -> typing.List[typing.Tuple]:
-    scale_set_nics = vmss_rest_api_list_nics(
-        token, subscription_id, resource_group_name, scale_set_name
-    )
-    if scale_set_nics is None:
-        logging.error(f"failed to get NICs for {scale_set_name}")
-        return []
-
-    cvuv_devices: typing.List[typing.Tuple] = []
-    for nic in scale_set_nics["value"]:
-        logging.info(f"nic: {nic}")
+    instance_id: typing.Optional[str] = None,
+) -> typing.Iterator[typing.Tuple[str, str, str]]:
+    for nic in vmss_rest_api_list_nics(
+        token,
+        subscription_id,
+        resource_group_name,
+        scale_set_name,
+        instance_id=instance_id,
+    ):
+        logs.payload("inventory", "nic", nic)
 
         if (
             "loadBalancerBackendAddressPools"
@@ -497,17 +1462,41 @@ def get_cvuv_ip_addresses(
 
         nic_id = nic["properties"]["virtualMachine"]["id"]
         device_id = nic_id.split("/")[-1]
-        cvuv_id = f"cvuv-{hashlib.sha1(nic_id.encode('utf-8')).hexdigest()[0:6]}"
+        cvuv_id = cvuv_name(nic_id)
+        remember_cvuv_name(nic_id, cvuv_id)
         logging.info(f"Found NIC: {nic_id}: {private_ip_address}")
-        cvuv_devices.append((private_ip_address, cvuv_id, device_id))
+        yield (private_ip_address, cvuv_id, device_id)
+
+
+# The name a cVu-V is registered under, derived from its VM resource ID.
+def cvuv_name(vm_id: str) -> str:
+    return f"cvuv-{hashlib.sha1(vm_id.encode('utf-8')).hexdigest()[0:6]}"
+
+
+# Names derived from the NICs listed by this worker, keyed by lowercased VM
+# resource ID, for the most recently listed `listed_names_size` VMs. ARM does
+# not always case a VM's resource ID the same in event subjects and in NICs.
+listed_names_size = 10000
+_listed_names: "collections.OrderedDict[str, str]" = collections.OrderedDict()
+_listed_names_lock = threading.Lock()
+
+
+def remember_cvuv_name(vm_id: str, name: str) -> None:
+    with _listed_names_lock:
+        _listed_names[vm_id.lower()] = name
+        _listed_names.move_to_end(vm_id.lower())
+        while len(_listed_names) > listed_names_size:
+            _listed_names.popitem(last=False)
+
 
-    return cvuv_devices
+def listed_cvuv_name(vm_id: str) -> typing.Optional[str]:
+    with _listed_names_lock:
+        return _listed_names.get(vm_id.lower())
 
 
 def get_vm_primary_ip_address(
-    instance: typing.Any, network_client: typing.Any, resource_group: str
+    primary_nic_id: str, network_client: typing.Any, resource_group: str
 ) -> typing.Optional[str]:
-    primary_nic_id = instance.network_profile.network_interfaces[0].id
     nic_name = primary_nic_id.split("/")[-1]
     nic_info = network_client.network_interfaces.get(resource_group, nic_name)
 
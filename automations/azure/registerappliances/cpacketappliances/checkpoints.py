@@ -0,0 +1,227 @@
+import abc
+import logging
+import os
+import typing
+
+from . import planning, stores
+
+# Where the progress of unfinished registrations is kept: "sqlite" (a file local
+# to the worker), "table" (an Azure Storage table shared by every instance of the
+# Function App) or "none".
+checkpoint_store = os.environ.get("REGISTRATION_CHECKPOINT_STORE", "sqlite")
+checkpoint_sqlite_path = stores.sqlite_path(
+    "REGISTRATION_CHECKPOINT_SQLITE_PATH", "cpacketappliances-checkpoints.db"
+)
+checkpoint_table_name = os.environ.get(
+    "REGISTRATION_CHECKPOINT_TABLE", "cpacketcheckpoints"
+)
+
+
+# The stages a cVu-V has completed since it was registered under `device_oid`.
+# Only unfinished registrations have a checkpoint: it is saved once the cVu-V is
+# registered, updated only when a later stage fails (every stage is safe to run
+# again), and removed once the last stage succeeds.
+class Checkpoint(typing.NamedTuple):
+    cvuv_ip: str
+    cvuv_name: str
+    device_oid: str
+    completed: typing.FrozenSet[str]
+
+
+class CheckpointStore(abc.ABC):
+    # Returns the checkpoints of the cVu-Vs registered with a cClear-V, keyed by
+    # cVu-V IP address.
+    @abc.abstractmethod
+    def load(self, cclearv_ip: str) -> typing.Dict[str, Checkpoint]:
+        ...
+
+    @abc.abstractmethod
+    def save(self, cclearv_ip: str, checkpoint: Checkpoint) -> None:
+        ...
+
+    # Removes the checkpoints of the cVu-Vs, if they have one.
+    @abc.abstractmethod
+    def discard(self, cclearv_ip: str, cvuv_ips: typing.List[str]) -> None:
+        ...
+
+
+class NullCheckpointStore(CheckpointStore):
+    def load(self, cclearv_ip: str) -> typing.Dict[str, Checkpoint]:
+        return {}
+
+    def save(self, cclearv_ip: str, checkpoint: Checkpoint) -> None:
+        pass
+
+    def discard(self, cclearv_ip: str, cvuv_ips: typing.List[str]) -> None:
+        pass
+
+
+def encode_stages(stages: typing.FrozenSet[str]) -> str:
+    return ",".join(sorted(stages))
+
+
+def decode_stages(value: str) -> typing.FrozenSet[str]:
+    return frozenset(stage for stage in value.split(",") if stage != "")
+
+
+class SqliteCheckpointStore(stores.SqliteStore, CheckpointStore):
+    def __init__(self, path: str):
+        # Registration workers write concurrently.
+        super().__init__(
+            path,
+            "CREATE TABLE IF NOT EXISTS checkpoints ("
+            "cclearv_ip TEXT NOT NULL, cvuv_ip TEXT NOT NULL, "
+            "cvuv_name TEXT NOT NULL, device_oid TEXT NOT NULL, "
+            "completed TEXT NOT NULL, PRIMARY KEY (cclearv_ip, cvuv_ip))",
+            wal=True,
+        )
+
+    def load(self, cclearv_ip: str) -> typing.Dict[str, Checkpoint]:
+        with self.connect() as connection:
+            rows = connection.execute(
+                "SELECT cvuv_ip, cvuv_name, device_oid, completed FROM checkpoints "
+                "WHERE cclearv_ip = ?",
+                (cclearv_ip,),
+            ).fetchall()
+        return {
+            cvuv_ip: Checkpoint(
+                cvuv_ip, cvuv_name, device_oid, decode_stages(completed)
+            )
+            for cvuv_ip, cvuv_name, device_oid, completed in rows
+        }
+
+    def save(self, cclearv_ip: str, checkpoint: Checkpoint) -> None:
+        with self.connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO checkpoints "
+                "(cclearv_ip, cvuv_ip, cvuv_name, device_oid, completed) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (
+                    cclearv_ip,
+                    checkpoint.cvuv_ip,
+                    checkpoint.cvuv_name,
+                    checkpoint.device_oid,
+                    encode_stages(checkpoint.completed),
+                ),
+            )
+
+    def discard(self, cclearv_ip: str, cvuv_ips: typing.List[str]) -> None:
+        with self.connect() as connection:
+            connection.executemany(
+                "DELETE FROM checkpoints WHERE cclearv_ip = ? AND cvuv_ip = ?",
+                [(cclearv_ip, cvuv_ip) for cvuv_ip in cvuv_ips],
+            )
+
+
+class TableCheckpointStore(stores.TableStore, CheckpointStore):
+    # A table transaction holds at most 100 operations on one partition.
+    transaction_size = 100
+
+    def load(self, cclearv_ip: str) -> typing.Dict[str, Checkpoint]:
+        return {
+            entity["RowKey"]: Checkpoint(
+                entity["RowKey"],
+                entity["cvuv_name"],
+                entity["device_oid"],
+                decode_stages(entity["completed"]),
+            )
+            for entity in self.table.query_entities(
+                "PartitionKey eq @cclearv_ip", parameters={"cclearv_ip": cclearv_ip}
+            )
+        }
+
+    def save(self, cclearv_ip: str, checkpoint: Checkpoint) -> None:
+        import azure.data.tables
+
+        self.table.upsert_entity(
+            {
+                "PartitionKey": cclearv_ip,
+                "RowKey": checkpoint.cvuv_ip,
+                "cvuv_name": checkpoint.cvuv_name,
+                "device_oid": checkpoint.device_oid,
+                "completed": encode_stages(checkpoint.completed),
+            },
+            mode=azure.data.tables.UpdateMode.REPLACE,
+        )
+
+    # The checkpoints of a cClear-V share a partition, so they are deleted in
+    # transactions. A transaction fails as a whole if one of its checkpoints is
+    # already gone, in which case they are deleted one at a time.
+    def discard(self, cclearv_ip: str, cvuv_ips: typing.List[str]) -> None:
+        import azure.data.tables
+
+        for start in range(0, len(cvuv_ips), self.transaction_size):
+            batch = cvuv_ips[start : start + self.transaction_size]
+            try:
+                self.table.submit_transaction(
+                    [
+                        ("delete", {"PartitionKey": cclearv_ip, "RowKey": cvuv_ip})
+                        for cvuv_ip in batch
+                    ]
+                )
+            except azure.data.tables.TableTransactionError:
+                for cvuv_ip in batch:
+                    self.table.delete_entity(cclearv_ip, cvuv_ip)
+
+
+def new_store() -> CheckpointStore:
+    if checkpoint_store == "table":
+        return TableCheckpointStore(checkpoint_table_name)
+    if checkpoint_store == "none":
+        return NullCheckpointStore()
+    return SqliteCheckpointStore(checkpoint_sqlite_path)
+
+
+_store = stores.Lazy(new_store)
+
+
+def get_store() -> CheckpointStore:
+    return _store.get()
+
+
+# Checkpoints only save work: if the store fails, registrations carry on without
+# them, as they did before checkpoints existed.
+def load(
+    cclearv_ip: str, registry: typing.Iterable[planning.RegisteredCvuv]
+) -> typing.Dict[str, Checkpoint]:
+    try:
+        checkpointed = get_store().load(cclearv_ip)
+    except Exception as e:
+        logging.error(f"failed to read registration checkpoints: {e}")
+        return {}
+
+    # A checkpoint is only valid while the cVu-V is still registered under the
+    # same device ID; otherwise its stages were done for another registration.
+    resumable: typing.Dict[str, Checkpoint] = {}
+    for device in registry:
+        checkpoint = checkpointed.get(device.ip)
+        if checkpoint is not None and checkpoint.device_oid == device.device_oid:
+            resumable[device.ip] = checkpoint
+    return resumable
+
+
+def save(cclearv_ip: str, checkpoint: Checkpoint) -> None:
+    try:
+        get_store().save(cclearv_ip, checkpoint)
+    except Exception as e:
+        logging.error(f"failed to save {checkpoint.cvuv_ip} checkpoint: {e}")
+
+
+def complete(checkpoint: Checkpoint, stage: str) -> Checkpoint:
+    return checkpoint._replace(completed=checkpoint.completed | {stage})
+
+
+# Saves the stages completed since `saved` was saved, if any.
+def update(cclearv_ip: str, saved: Checkpoint, checkpoint: Checkpoint) -> None:
+    if checkpoint.completed != saved.completed:
+        save(cclearv_ip, checkpoint)
+
+
+def discard(cclearv_ip: str, cvuv_ips: typing.Iterable[str]) -> None:
+    cvuv_ips = list(cvuv_ips)
+    if len(cvuv_ips) == 0:
+        return
+    try:
+        get_store().discard(cclearv_ip, cvuv_ips)
+    except Exception as e:
+        logging.error(f"failed to discard {len(cvuv_ips)} checkpoints: {e}")
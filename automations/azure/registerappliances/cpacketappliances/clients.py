@@ -0,0 +1,121 @@
+import logging
+import threading
+import time
+import typing
+
+from . import throttling, tokens
+from .settings import get_env_float
+
+if typing.TYPE_CHECKING:
+    import azure.mgmt.compute
+    import azure.mgmt.network
+
+# Seconds a cached credential, subscription list and client set is reused for.
+# 0 keeps them until they are invalidated.
+client_cache_ttl = get_env_float("AZURE_CLIENT_CACHE_TTL", 0.0)
+
+
+class AzureClients(typing.NamedTuple):
+    credential: tokens.CachingTokenCredential
+    subscription_id: str
+    compute_client: "azure.mgmt.compute.ComputeManagementClient"
+    network_client: "azure.mgmt.network.NetworkManagementClient"
+    created: float
+
+
+# None of these change between events, so a warm worker builds them once
+# instead of on every invocation. The SDK packages are only imported here, so
+# events that are ignored never load them. Clients are built per subscription;
+# the credential is shared by all of them.
+_credential: typing.Optional[typing.Tuple[tokens.CachingTokenCredential, float]] = None
+_cached: typing.Dict[str, AzureClients] = {}
+_subscription_ids: typing.Optional[typing.Tuple[typing.List[str], float]] = None
+_cached_lock = threading.RLock()
+
+
+def get_credential() -> tokens.CachingTokenCredential:
+    global _credential
+    with _cached_lock:
+        if _credential is not None and not expired(_credential[1]):
+            return _credential[0]
+
+        import azure.identity
+
+        credential = tokens.CachingTokenCredential(
+            azure.identity.ManagedIdentityCredential()
+        )
+        _credential = (credential, time.monotonic())
+        return credential
+
+
+def get_clients(subscription_id: str) -> typing.Optional[AzureClients]:
+    with _cached_lock:
+        cached = _cached.get(subscription_id)
+        if cached is not None and not expired(cached.created):
+            return cached
+
+        import azure.mgmt.compute
+        import azure.mgmt.network
+
+        credential = get_credential()
+        cached = AzureClients(
+            credential=credential,
+            subscription_id=subscription_id,
+            compute_client=azure.mgmt.compute.ComputeManagementClient(
+                credential,
+                subscription_id=subscription_id,
+                per_retry_policies=[throttling.arm_policy()],
+            ),
+            network_client=azure.mgmt.network.NetworkManagementClient(
+                credential,
+                subscription_id=subscription_id,
+                per_retry_policies=[throttling.arm_policy()],
+            ),
+            created=time.monotonic(),
+        )
+        _cached[subscription_id] = cached
+        return cached
+
+
+def expired(created: float) -> bool:
+    if client_cache_ttl <= 0:
+        return False
+    return time.monotonic() - created >= client_cache_ttl
+
+
+def invalidate(reason: str) -> None:
+    global _credential, _subscription_ids
+    with _cached_lock:
+        if _credential is not None:
+            logging.info(f"discarding cached Azure clients: {reason}")
+        _credential = None
+        _cached.clear()
+        _subscription_ids = None
+
+
+# Returns the subscriptions the managed identity can see, or None if they could
+# not be listed.
+def get_subscription_ids() -> typing.Optional[typing.List[str]]:
+    global _subscription_ids
+    with _cached_lock:
+        if _subscription_ids is not None and not expired(_subscription_ids[1]):
+            return _subscription_ids[0]
+
+        import azure.mgmt.subscription
+
+        subscriptions_client = azure.mgmt.subscription.SubscriptionClient(
+            get_credential(), per_retry_policies=[throttling.arm_policy()]
+        )
+        subscription_ids = [
+            subscription.subscription_id
+            for subscription in subscriptions_client.subscriptions.list()
+            if subscription.subscription_id is not None
+            and subscription.state in (None, "Enabled")
+        ]
+        if len(subscription_ids) == 0:
+            logging.error("failed to get any subscriptions")
+            return None
+
+        logging.info(f"visible subscriptions: {','.join(subscription_ids)}")
+        _subscription_ids = (subscription_ids, time.monotonic())
+        return subscription_ids
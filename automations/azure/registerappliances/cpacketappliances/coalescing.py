@@ -0,0 +1,186 @@
+import abc
+import logging
+import os
+import time
+import typing
+
+from . import stores, telemetry
+from .settings import get_env_float
+
+# Seconds to wait for further events on the same scale set before reconciling
+# it. 0 disables coalescing: every event reconciles immediately.
+coalesce_window = get_env_float("EVENT_COALESCE_WINDOW", 0.0)
+# Where pending events are tracked: "sqlite" (a file local to the worker) or
+# "table" (an Azure Storage table shared by every instance of the Function App).
+coalesce_store = os.environ.get("EVENT_COALESCE_STORE", "sqlite")
+coalesce_sqlite_path = stores.sqlite_path(
+    "EVENT_COALESCE_SQLITE_PATH", "cpacketappliances-coalescing.db"
+)
+coalesce_table_name = os.environ.get("EVENT_COALESCE_TABLE", "cpacketcoalescing")
+
+coalesced_events = "cpacket.events.coalesced"
+
+
+# Each scale set has a generation, bumped by every event, and a count of events
+# not yet covered by a reconcile. An invocation records its event, waits for the
+# window and reconciles only if no later event arrived in the meantime, in which
+# case it claims (and resets) the pending count.
+class CoalescingStore(abc.ABC):
+    @abc.abstractmethod
+    def record(self, key: str) -> int:
+        ...
+
+    @abc.abstractmethod
+    def claim(self, key: str, generation: int) -> typing.Optional[int]:
+        ...
+
+
+class SqliteCoalescingStore(stores.SqliteStore, CoalescingStore):
+    def __init__(self, path: str):
+        super().__init__(
+            path,
+            "CREATE TABLE IF NOT EXISTS pending ("
+            "key TEXT PRIMARY KEY, generation INTEGER NOT NULL, "
+            "events INTEGER NOT NULL, updated REAL NOT NULL)",
+        )
+
+    def record(self, key: str) -> int:
+        with self.connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute(
+                "INSERT INTO pending (key, generation, events, updated) "
+                "VALUES (?, 1, 1, ?) ON CONFLICT(key) DO UPDATE SET "
+                "generation = generation + 1, events = events + 1, updated = ?",
+                (key, time.time(), time.time()),
+            )
+            (generation,) = connection.execute(
+                "SELECT generation FROM pending WHERE key = ?", (key,)
+            ).fetchone()
+            connection.execute("COMMIT")
+        return generation
+
+    def claim(self, key: str, generation: int) -> typing.Optional[int]:
+        with self.connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute(
+                "SELECT generation, events FROM pending WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or row[0] != generation or row[1] == 0:
+                connection.execute("COMMIT")
+                return None
+            connection.execute(
+                "UPDATE pending SET events = 0, updated = ? WHERE key = ?",
+                (time.time(), key),
+            )
+            connection.execute("COMMIT")
+        return row[1]
+
+
+class TableCoalescingStore(stores.TableStore, CoalescingStore):
+    partition_key = "scale-set"
+
+    def record(self, key: str) -> int:
+        import azure.core.exceptions
+
+        while True:
+            entity = self.get(key)
+            if entity is None:
+                try:
+                    self.table.create_entity(
+                        {
+                            "PartitionKey": self.partition_key,
+                            "RowKey": key,
+                            "generation": 1,
+                            "events": 1,
+                        }
+                    )
+                    return 1
+                except azure.core.exceptions.ResourceExistsError:
+                    continue
+
+            entity["generation"] += 1
+            entity["events"] += 1
+            if self.replace(entity):
+                return entity["generation"]
+
+    def claim(self, key: str, generation: int) -> typing.Optional[int]:
+        while True:
+            entity = self.get(key)
+            if (
+                entity is None
+                or entity["generation"] != generation
+                or entity["events"] == 0
+            ):
+                return None
+
+            events = entity["events"]
+            entity["events"] = 0
+            if self.replace(entity):
+                return events
+
+    def get(self, key: str) -> typing.Optional[typing.Any]:
+        import azure.core.exceptions
+
+        try:
+            return self.table.get_entity(self.partition_key, key)
+        except azure.core.exceptions.ResourceNotFoundError:
+            return None
+
+    # Optimistic concurrency: fails if another invocation updated the entity
+    # since it was read.
+    def replace(self, entity: typing.Any) -> bool:
+        import azure.core
+        import azure.core.exceptions
+        import azure.data.tables
+
+        try:
+            self.table.update_entity(
+                entity,
+                mode=azure.data.tables.UpdateMode.REPLACE,
+                etag=entity.metadata["etag"],
+                match_condition=azure.core.MatchConditions.IfNotModified,
+            )
+            return True
+        except azure.core.exceptions.ResourceModifiedError:
+            return False
+
+
+def new_store() -> CoalescingStore:
+    if coalesce_store == "table":
+        return TableCoalescingStore(coalesce_table_name)
+    return SqliteCoalescingStore(coalesce_sqlite_path)
+
+
+_store = stores.Lazy(new_store)
+
+
+def get_store() -> CoalescingStore:
+    return _store.get()
+
+
+# Returns the scale set's subscription, resource group and name from an event
+# subject such as
+# /subscriptions/<id>/resourceGroups/<group>/providers/Microsoft.Compute/virtualMachineScaleSets/<name>
+def scale_set_key(subject: str) -> str:
+    parts = subject.split("/")
+    return ":".join([parts[2], parts[-5], parts[-1]]).lower()
+
+
+# Returns the number of events this invocation's reconcile covers, or None if a
+# later event for the same scale set will do the reconcile instead.
+def coalesce(subject: str) -> typing.Optional[int]:
+    if coalesce_window <= 0:
+        return 1
+
+    key = scale_set_key(subject)
+    store = get_store()
+    generation = store.record(key)
+    time.sleep(coalesce_window)
+    events = store.claim(key, generation)
+    if events is None:
+        logging.info(f"a later event will reconcile {key}: skipping")
+        return None
+
+    logging.info(f"reconciling {key}: coalesced {events} events")
+    telemetry.observe(coalesced_events, events)
+    return events
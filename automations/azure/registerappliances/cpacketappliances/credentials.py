@@ -0,0 +1,176 @@
+import abc
+import logging
+import os
+import threading
+import time
+import typing
+
+from . import clients
+from .settings import get_env_float
+
+# Key Vault holding the appliance password, e.g. https://cpacket.vault.azure.net,
+# read with the Function App's managed identity. Empty reads the password from
+# the APPLIANCE_HTTP_BASIC_AUTH_PASSWORD app setting instead.
+key_vault_url = os.environ.get("APPLIANCE_KEY_VAULT_URL", "")
+secret_name = os.environ.get("APPLIANCE_SECRET_NAME", "cpacket")
+# Seconds the password is reused before it is read again, and how long before
+# that it is re-read in the background so no request waits on Key Vault.
+credential_ttl = get_env_float("APPLIANCE_CREDENTIAL_CACHE_TTL", 3600.0)
+credential_refresh_margin = get_env_float("APPLIANCE_CREDENTIAL_REFRESH_MARGIN", 300.0)
+
+# Seconds before a failed read is retried. Until then the password read last,
+# if any, is still used.
+retry_interval = 30.0
+
+password_setting = "APPLIANCE_HTTP_BASIC_AUTH_PASSWORD"
+
+
+# Raised when the appliance password is needed but has never been read.
+class PasswordUnavailable(Exception):
+    pass
+
+
+class SecretSource(abc.ABC):
+    name = ""
+
+    @abc.abstractmethod
+    def read(self) -> typing.Optional[str]:
+        ...
+
+
+class SettingSecretSource(SecretSource):
+    name = f"app setting {password_setting}"
+
+    def read(self) -> typing.Optional[str]:
+        return os.environ.get(password_setting)
+
+
+class KeyVaultSecretSource(SecretSource):
+    def __init__(self, vault_url: str, secret: str):
+        import azure.keyvault.secrets
+
+        self.name = f"secret {secret} in {vault_url}"
+        self.secret = secret
+        self.client = azure.keyvault.secrets.SecretClient(
+            vault_url, credential=clients.get_credential()
+        )
+
+    def read(self) -> typing.Optional[str]:
+        return self.client.get_secret(self.secret).value
+
+
+# Caches the password read from a source. A password close to expiry is still
+# returned while a replacement is read on a background thread, and concurrent
+# callers of an expired one wait for a single read.
+class CachedSecret:
+    def __init__(self, source: SecretSource):
+        self.source = source
+        self.value: typing.Optional[str] = None
+        self.expires = 0.0
+        self.read_at = 0.0
+        self.retry_at = 0.0
+        self.refreshing = False
+        # Whether the next read, and the last one, follow a rejection.
+        self.invalidated = False
+        self.reread = False
+        self.lock = threading.Lock()
+        self.read_lock = threading.Lock()
+
+    def get(self) -> typing.Optional[str]:
+        with self.lock:
+            if self.usable(time.monotonic()):
+                return self.value
+        return self.read()
+
+    # Whether the cached value (after a failed read, whatever was read before)
+    # can be used now. Starts a background refresh when it is close to expiry.
+    # Called with the lock held.
+    def usable(self, now: float) -> bool:
+        if self.value is not None and now < self.expires:
+            if now >= self.expires - credential_refresh_margin and not self.refreshing:
+                self.refreshing = True
+                threading.Thread(
+                    target=self.refresh, name="credential-refresh", daemon=True
+                ).start()
+            return True
+        return now < self.retry_at
+
+    def read(self) -> typing.Optional[str]:
+        with self.read_lock:
+            # Another thread may have read it while this one waited.
+            with self.lock:
+                if self.usable(time.monotonic()):
+                    return self.value
+            return self.fetch()
+
+    def fetch(self) -> typing.Optional[str]:
+        try:
+            value = self.source.read()
+            if value is None:
+                logging.error(f"{self.source.name} has no value")
+        except Exception as e:
+            logging.error(
+                f"failed to read appliance password from {self.source.name}: {e}"
+            )
+            value = None
+
+        now = time.monotonic()
+        with self.lock:
+            if value is None:
+                self.retry_at = now + retry_interval
+            else:
+                if self.value is not None and value != self.value:
+                    logging.info(f"appliance password in {self.source.name} changed")
+                self.value = value
+                self.read_at = now
+                self.expires = now + credential_ttl
+                self.reread = self.invalidated
+                self.invalidated = False
+            return self.value
+
+    def refresh(self) -> None:
+        try:
+            with self.read_lock:
+                self.fetch()
+        finally:
+            with self.lock:
+                self.refreshing = False
+
+    # Called when an appliance rejected `rejected`: unless the password has
+    # been read again since, the next caller reads it from the source. If it
+    # was just read again because of a rejection, it is not read again for
+    # `retry_interval` seconds, so a wrong password costs one read, not one per
+    # failed request.
+    def invalidate(self, rejected: str) -> None:
+        with self.lock:
+            if self.value != rejected:
+                return
+            if self.reread and time.monotonic() - self.read_at < retry_interval:
+                return
+            self.expires = 0.0
+            self.retry_at = 0.0
+            self.invalidated = True
+
+
+_secret: typing.Optional[CachedSecret] = None
+_secret_lock = threading.Lock()
+
+
+def get_secret() -> CachedSecret:
+    global _secret
+    with _secret_lock:
+        if _secret is None:
+            if key_vault_url != "":
+                _secret = CachedSecret(KeyVaultSecretSource(key_vault_url, secret_name))
+            else:
+                _secret = CachedSecret(SettingSecretSource())
+        return _secret
+
+
+# Returns the appliance password, or None if it has never been read.
+def get_password() -> typing.Optional[str]:
+    return get_secret().get()
+
+
+def invalidate(rejected: str) -> None:
+    get_secret().invalidate(rejected)
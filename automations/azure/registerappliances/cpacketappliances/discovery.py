@@ -0,0 +1,110 @@
+import concurrent.futures
+import logging
+import threading
+import time
+import typing
+
+from . import telemetry
+from .settings import get_env_float
+
+# Seconds the discovered cClear-V addresses are reused before it is looked up again.
+# 0 disables the cache.
+cclearv_address_ttl = get_env_float("CCLEARV_ADDRESS_CACHE_TTL", 3600.0)
+
+# (subscription, resource group, tag name, tag value) -> (cClear-V IP addresses,
+# time cached)
+_addresses: typing.Dict[
+    typing.Tuple[str, str, str, str], typing.Tuple[typing.List[str], float]
+] = {}
+_addresses_lock = threading.Lock()
+
+
+def cached_addresses(
+    subscription_id: str,
+    resource_group_name: str,
+    tag_name: str,
+    tag_value: str,
+    lookup: typing.Callable[[], typing.Optional[typing.List[str]]],
+) -> typing.Optional[typing.List[str]]:
+    key = (subscription_id.lower(), resource_group_name.lower(), tag_name, tag_value)
+    with _addresses_lock:
+        cached = _addresses.get(key)
+    if cached is not None and time.monotonic() - cached[1] < cclearv_address_ttl:
+        return list(cached[0])
+
+    addresses = lookup()
+    if addresses is not None and cclearv_address_ttl > 0:
+        with _addresses_lock:
+            _addresses[key] = (list(addresses), time.monotonic())
+    return addresses
+
+
+# Called when a request to `address` fails to connect: the appliance may have
+# moved, so the next lookup of its resource group goes back to Azure.
+def invalidate_address(address: str) -> None:
+    with _addresses_lock:
+        stale = [key for key, value in _addresses.items() if address in value[0]]
+        for key in stale:
+            del _addresses[key]
+    if len(stale) > 0:
+        logging.info(f"discarding cached cClear-V address {address}")
+
+
+# A lookup made before the cClear-V registry and the scale set can be compared.
+# `work` is called with the results of the steps named in `after`, in that
+# order.
+class Step(typing.NamedTuple):
+    work: typing.Callable[..., typing.Any]
+    after: typing.Tuple[str, ...] = ()
+
+
+# Runs each step as soon as the steps it depends on have finished, so the
+# lookups take as long as their longest chain instead of their sum. A step whose
+# dependency failed (returned None) is skipped and returns None as well. Each
+# step is timed as the phase of the same name. Returns the results by step name.
+def run_graph(
+    steps: typing.Dict[str, Step],
+    initializer: typing.Optional[typing.Callable[[], None]] = None,
+) -> typing.Dict[str, typing.Any]:
+    def timed(name: str, *inputs: typing.Any) -> typing.Any:
+        with telemetry.phase(name):
+            return steps[name].work(*inputs)
+
+    results: typing.Dict[str, typing.Any] = {}
+    waiting = dict(steps)
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(len(steps), 1),
+        thread_name_prefix="discovery",
+        initializer=initializer,
+    ) as executor:
+        running: typing.Dict[concurrent.futures.Future, str] = {}
+
+        def submit_ready() -> None:
+            # Skipping a step can make the steps after it ready in turn.
+            skipped = True
+            while skipped:
+                skipped = False
+                ready = [
+                    name
+                    for name, step in waiting.items()
+                    if all(dependency in results for dependency in step.after)
+                ]
+                for name in ready:
+                    step = waiting.pop(name)
+                    inputs = [results[dependency] for dependency in step.after]
+                    if any(value is None for value in inputs):
+                        results[name] = None
+                        skipped = True
+                    else:
+                        running[executor.submit(timed, name, *inputs)] = name
+
+        submit_ready()
+        while running:
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                results[running.pop(future)] = future.result()
+            submit_ready()
+
+    return results
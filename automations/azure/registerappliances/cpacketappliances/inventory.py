@@ -0,0 +1,221 @@
+import abc
+import concurrent.futures
+import logging
+import re
+import threading
+import typing
+
+from . import logs, planning
+
+# Statuses with which a cClear-V answers a request for an API it does not have.
+unsupported_statuses = (404, 405)
+
+
+class Response(typing.NamedTuple):
+    # None if the request failed before a response was received.
+    status: typing.Optional[int]
+    # The decoded JSON body of a successful response.
+    body: typing.Any
+
+
+# GETs a path on the cClear-V.
+Fetch = typing.Callable[[str], Response]
+
+
+class Unsupported(Exception):
+    pass
+
+
+# Reads the registered cVu-Vs (IP address, name and device ID) from one cClear-V
+# API. Different cClear-V versions expose different APIs, and they also differ in
+# how metrics collection is switched on for a device.
+class InventoryAdapter(abc.ABC):
+    name = ""
+    # Number of requests a read takes; the cheapest supported adapter is used.
+    cost = 0
+    metrics_config_path = ""
+
+    # Returns None if the registry could not be read, and raises Unsupported if
+    # the cClear-V does not have this API.
+    @abc.abstractmethod
+    def read(
+        self, fetch: Fetch
+    ) -> typing.Optional[typing.List[planning.RegisteredCvuv]]:
+        ...
+
+    def metrics_config_payload(
+        self, device_id: str, device_name: str
+    ) -> typing.Dict[str, typing.Any]:
+        return {
+            "device_oid": device_id,
+            "device_name": device_name,
+            "config": {
+                "collect": True,
+            },
+        }
+
+
+def get(fetch: Fetch, path: str) -> typing.Any:
+    response = fetch(path)
+    if response.status in unsupported_statuses:
+        raise Unsupported(f"{path} returned HTTP {response.status}")
+    return response.body
+
+
+# One request returns every cVu-V with its address and device ID.
+class DiagDevicesAdapter(InventoryAdapter):
+    name = "diag-devices"
+    cost = 1
+    metrics_config_path = "/cvu/metrics_config"
+
+    def read(
+        self, fetch: Fetch
+    ) -> typing.Optional[typing.List[planning.RegisteredCvuv]]:
+        decoded = get(fetch, "/diag/devices/")  # note trailing slash
+        if decoded is None:
+            return None
+        if "cvu" not in decoded:
+            logging.info("no cVu-V devices found in call to `/diag/devices/`")
+            return None
+
+        devices = decoded["cvu"]
+        logs.payload("registry", "cClear-V devices", devices)
+        return [
+            planning.RegisteredCvuv(
+                ip=device["ip"], name=device.get("name", ""), device_oid=device["_id"]
+            )
+            for device in devices
+        ]
+
+
+# The full configuration dump gives each device's address, and the metrics
+# configuration its device ID. Neither depends on the other, so both are
+# fetched at once.
+class DebugDumpAdapter(InventoryAdapter):
+    name = "debug-dump"
+    cost = 2
+    metrics_config_path = "/cfg/metrics_config"
+
+    def read(
+        self, fetch: Fetch
+    ) -> typing.Optional[typing.List[planning.RegisteredCvuv]]:
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="cclearv-metrics-config"
+        ) as executor:
+            # note the LACK of a trailing slash
+            metrics_config_request = executor.submit(get, fetch, "/cfg/metrics_config")
+            decoded = get(fetch, "/cfg/debug/dump/")  # note trailing slash
+            if decoded is None:
+                return None
+            cvuv_metrics_config = metrics_config(metrics_config_request.result())
+        registered_cvuv_devices = decoded["get_device_info"]
+        logs.payload("registry", "cClear-V devices", registered_cvuv_devices)
+
+        if cvuv_metrics_config is None:
+            logging.info("failed to get cVu-V metrics config")
+            return None
+
+        if len(cvuv_metrics_config) != len(registered_cvuv_devices):
+            logging.info("cVu-V metrics config does not match registered cVu-V devices")
+
+        cvuv_registry: typing.List[planning.RegisteredCvuv] = []
+        for (name, device) in registered_cvuv_devices.items():
+            ip = extract_registered_cvuv_ip(device["devurl"])
+            if ip is None:
+                continue
+            if name not in cvuv_metrics_config:
+                continue
+
+            cvuv_registry.append(
+                planning.RegisteredCvuv(
+                    ip=ip, name=name, device_oid=cvuv_metrics_config[name]["deviceOid"]
+                )
+            )
+        return cvuv_registry
+
+    def metrics_config_payload(
+        self, device_id: str, device_name: str
+    ) -> typing.Dict[str, typing.Any]:
+        return {
+            "category": "cvu",
+            **super().metrics_config_payload(device_id, device_name),
+        }
+
+
+def metrics_config(
+    decoded: typing.Any,
+) -> typing.Optional[typing.Dict[str, typing.Any]]:
+    if decoded is None:
+        return None
+
+    if "data" not in decoded:
+        logging.error("no data in decoded response")
+        return None
+
+    if "metrics" not in decoded["data"]:
+        logging.error("no metrics in decoded response")
+        return None
+
+    devices = {}
+    for device in decoded["data"]["metrics"]:
+        if device["category"] == "cvu":
+            devices[device["deviceName"]] = device
+    logs.payload("registry", "cVu-V metrics config", devices)
+    return devices
+
+
+def extract_registered_cvuv_ip(device: str) -> typing.Optional[str]:
+    ip = re.search(r"//(.+)", device)
+    if ip is not None:
+        return ip.group(1)
+    logging.error(f"failed to extract IP address from {device}")
+    return None
+
+
+adapters: typing.List[InventoryAdapter] = sorted(
+    [DiagDevicesAdapter(), DebugDumpAdapter()], key=lambda adapter: adapter.cost
+)
+
+# The adapter found to work with each cClear-V address. A cClear-V only changes
+# API when it is upgraded, so the probe is repeated only if the adapter stops
+# being supported.
+_selected: typing.Dict[str, InventoryAdapter] = {}
+_selected_lock = threading.Lock()
+
+
+def selected_adapter(cclearv_ip: str) -> InventoryAdapter:
+    with _selected_lock:
+        return _selected.get(cclearv_ip, adapters[0])
+
+
+def read_registry(
+    cclearv_ip: str, fetch: Fetch
+) -> typing.Optional[typing.List[planning.RegisteredCvuv]]:
+    with _selected_lock:
+        selected = _selected.get(cclearv_ip)
+    if selected is not None:
+        try:
+            return selected.read(fetch)
+        except Unsupported as e:
+            logging.info(f"{cclearv_ip} no longer supports {selected.name}: {e}")
+            with _selected_lock:
+                _selected.pop(cclearv_ip, None)
+
+    # Cheapest first. A failed read (rather than a missing API) ends the probe
+    # without caching anything, since it says nothing about what is supported.
+    for adapter in adapters:
+        try:
+            registry = adapter.read(fetch)
+        except Unsupported as e:
+            logging.info(f"{cclearv_ip} does not support {adapter.name}: {e}")
+            continue
+        if registry is not None:
+            logging.info(
+                f"reading the cVu-V inventory of {cclearv_ip} with {adapter.name}"
+            )
+            with _selected_lock:
+                _selected[cclearv_ip] = adapter
+        return registry
+
+    logging.error(f"{cclearv_ip} supports none of the known cVu-V inventory APIs")
+    return None
@@ -0,0 +1,89 @@
+import concurrent.futures
+import logging
+import socket
+import ssl
+import time
+import typing
+
+from .settings import get_env_float, get_env_int
+
+# Seconds allowed for the TCP connection to a cVu-V's HTTPS port.
+probe_connect_timeout = get_env_float("CVUV_PROBE_CONNECT_TIMEOUT", 3.0)
+# Seconds allowed for the TLS handshake once connected.
+probe_read_timeout = get_env_float("CVUV_PROBE_READ_TIMEOUT", 5.0)
+# Seconds allowed for probing every candidate, however many there are.
+probe_deadline = get_env_float("CVUV_PROBE_DEADLINE", 15.0)
+probe_workers = get_env_int("CVUV_PROBE_WORKERS", 32)
+
+probe_port = 443
+
+# The appliances use self-signed certificates: the probe only checks that a TLS
+# endpoint answers, not who it is.
+_tls_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+_tls_context.check_hostname = False
+_tls_context.verify_mode = ssl.CERT_NONE
+
+
+# Returns None if the cVu-V answered, otherwise the reason it is considered dead.
+def probe(ip: str, connect_timeout: float, read_timeout: float) -> typing.Optional[str]:
+    try:
+        sock = socket.create_connection((ip, probe_port), timeout=connect_timeout)
+    except OSError as e:
+        return f"connection failed: {e}"
+
+    try:
+        sock.settimeout(read_timeout)
+        with _tls_context.wrap_socket(sock):
+            pass
+    except socket.timeout as e:
+        return f"TLS handshake timed out: {e}"
+    except (ssl.SSLError, OSError):
+        # Something accepted the connection, so the VM is still there.
+        pass
+    finally:
+        sock.close()
+    return None
+
+
+# Probes every IP concurrently and returns the ones that did not answer, with the
+# reason. IPs whose probe is still running when the deadline expires are left
+# out: they are not known to be dead, and removing a live cVu-V is worse than
+# keeping a dead one until the next run.
+def find_unreachable(ips: typing.Iterable[str]) -> typing.Dict[str, str]:
+    candidates = sorted(set(ips))
+    if len(candidates) == 0:
+        return {}
+
+    started = time.monotonic()
+    unreachable: typing.Dict[str, str] = {}
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(max(probe_workers, 1), len(candidates)),
+        thread_name_prefix="cvuv-probe",
+    )
+    try:
+        futures = {
+            executor.submit(
+                probe,
+                ip,
+                min(probe_connect_timeout, probe_deadline),
+                min(probe_read_timeout, probe_deadline),
+            ): ip
+            for ip in candidates
+        }
+        done, not_done = concurrent.futures.wait(futures, timeout=probe_deadline)
+        for future in done:
+            reason = future.result()
+            if reason is not None:
+                unreachable[futures[future]] = reason
+        for future in not_done:
+            future.cancel()
+            logging.info(
+                f"probe of cVu-V {futures[future]} did not finish within {probe_deadline}s: keeping it"
+            )
+    finally:
+        executor.shutdown(wait=False)
+
+    logging.info(
+        f"probed {len(candidates)} cVu-Vs in {time.monotonic() - started:.1f}s: {len(unreachable)} unreachable"
+    )
+    return unreachable
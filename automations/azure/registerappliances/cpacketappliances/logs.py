@@ -0,0 +1,72 @@
+import itertools
+import json
+import logging
+import os
+import typing
+
+from .settings import get_env_int
+
+# Lists and mappings with more entries than this are summarized by their length
+# and their first `payload_sample_size` entries.
+payload_max_items = get_env_int("LOG_PAYLOAD_MAX_ITEMS", 10)
+payload_sample_size = get_env_int("LOG_PAYLOAD_SAMPLE_SIZE", 3)
+# Longest rendering of a payload, in characters, before it is cut.
+payload_max_chars = get_env_int("LOG_PAYLOAD_MAX_CHARS", 2000)
+
+# Level at which each phase logs the payloads it handles. The per-NIC and
+# per-request dumps are only useful when debugging a single scale set.
+default_payload_levels = {
+    "event": logging.INFO,
+    "registry": logging.INFO,
+    "plan": logging.INFO,
+    "inventory": logging.DEBUG,
+    "register": logging.DEBUG,
+}
+
+
+# LOG_PAYLOAD_LEVELS overrides the defaults, e.g. "inventory=info,registry=debug".
+def parse_levels(value: str) -> typing.Dict[str, int]:
+    levels = dict(default_payload_levels)
+    for entry in value.split(","):
+        if entry.strip() == "":
+            continue
+        phase, _, name = entry.partition("=")
+        level = logging.getLevelName(name.strip().upper())
+        if not isinstance(level, int):
+            logging.error(f"ignoring invalid LOG_PAYLOAD_LEVELS entry: {entry}")
+            continue
+        levels[phase.strip()] = level
+    return levels
+
+
+payload_levels = parse_levels(os.environ.get("LOG_PAYLOAD_LEVELS", ""))
+
+
+# Renders a payload when (and only if) the record is emitted.
+class Payload:
+    def __init__(self, value: typing.Any):
+        self.value = value
+
+    def __str__(self) -> str:
+        rendered = json.dumps(summarize(self.value), sort_keys=True, default=str)
+        if len(rendered) > payload_max_chars:
+            cut = len(rendered) - payload_max_chars
+            rendered = f"{rendered[:payload_max_chars]}... ({cut} more characters)"
+        return rendered
+
+
+def summarize(value: typing.Any) -> typing.Any:
+    if isinstance(value, dict) and len(value) > payload_max_items:
+        sample = dict(itertools.islice(value.items(), payload_sample_size))
+        return {"count": len(value), "sample": sample}
+    if isinstance(value, (list, tuple)) and len(value) > payload_max_items:
+        return {"count": len(value), "sample": list(value[:payload_sample_size])}
+    return value
+
+
+# Logs `value` under `message` at the level configured for `phase`. Nothing is
+# serialized unless that level is enabled.
+def payload(phase: str, message: str, value: typing.Any) -> None:
+    level = payload_levels.get(phase, logging.DEBUG)
+    if logging.getLogger().isEnabledFor(level):
+        logging.log(level, "%s: %s", message, Payload(value))
@@ -0,0 +1,116 @@
+import re
+import typing
+
+# This module only plans: it makes no network calls and has no dependencies, so
+# planning cost can be measured on its own (see benchmarks/plan_benchmark.py).
+
+# Names this function registers cVu-Vs under (see cvuv_name()). A device
+# registered under any other name was set up by hand and is left alone.
+generated_name = re.compile(r"cvuv-[0-9a-f]{6}")
+
+
+class InventoryCvuv(typing.NamedTuple):
+    ip: str
+    name: str
+    device_id: str
+
+
+class RegisteredCvuv(typing.NamedTuple):
+    ip: str
+    name: str
+    device_oid: str
+
+
+class Plan(typing.NamedTuple):
+    # In the scale set but not registered with cClear-V.
+    register: typing.List[InventoryCvuv]
+    # Registered under another cVu-V's name: the IP address was reused by a new
+    # instance. The old registration is replaced with one under its own name.
+    # Only names this function generated are replaced.
+    repair: typing.List[InventoryCvuv]
+    # Registered but no longer in the scale set. Removed once they fail a
+    # liveness probe.
+    remove: typing.List[RegisteredCvuv]
+    # Registered and in the scale set.
+    noop: typing.List[InventoryCvuv]
+    # Registered, and in the scale set, but assigned to another cClear-V.
+    # Removed once the cVu-V is set up with that cClear-V.
+    moved: typing.List[RegisteredCvuv]
+
+
+# Compares the scale set inventory with the cClear-V registry in O(inventory +
+# registry). When the inventory is partial (a single instance), registered
+# cVu-Vs missing from it are not removal candidates.
+def plan(
+    inventory: typing.Iterable[typing.Tuple[str, str, str]],
+    registry: typing.Iterable[RegisteredCvuv],
+    complete_inventory: bool = True,
+) -> Plan:
+    registered_by_ip: typing.Dict[str, RegisteredCvuv] = {
+        device.ip: device for device in registry
+    }
+
+    result = Plan(register=[], repair=[], remove=[], noop=[], moved=[])
+    inventory_ips: typing.Set[str] = set()
+    for ip, name, device_id in inventory:
+        device = InventoryCvuv(ip=ip, name=name, device_id=device_id)
+        inventory_ips.add(ip)
+        registered = registered_by_ip.get(ip)
+        if registered is None:
+            result.register.append(device)
+        elif (
+            registered.name != name
+            and generated_name.fullmatch(registered.name) is not None
+        ):
+            result.repair.append(device)
+        else:
+            result.noop.append(device)
+
+    if complete_inventory:
+        for ip, registered in registered_by_ip.items():
+            if ip not in inventory_ips:
+                result.remove.append(registered)
+
+    return result
+
+
+# Plans each cClear-V's share of the scale set, as assigned by `owner`, against
+# that cClear-V's registry. What a cClear-V has registered but is not its share
+# is either gone from the scale set (`remove`) or owned by another cClear-V
+# (`moved`). When the inventory is incomplete, neither can be told apart from a
+# cVu-V missing from it, so nothing is planned for removal.
+def plan_shards(
+    inventory: typing.Iterable[typing.Tuple[str, str, str]],
+    registries: typing.Dict[str, typing.List[RegisteredCvuv]],
+    owner: typing.Callable[[str], str],
+    complete_inventory: bool = True,
+) -> typing.Dict[str, Plan]:
+    shards: typing.Dict[str, typing.List[typing.Tuple[str, str, str]]] = {
+        cclearv_ip: [] for cclearv_ip in registries
+    }
+    inventory_ips: typing.Set[str] = set()
+    for device in inventory:
+        inventory_ips.add(device[0])
+        cclearv_ip = owner(device[1])
+        if cclearv_ip in shards:
+            shards[cclearv_ip].append(device)
+
+    plans: typing.Dict[str, Plan] = {}
+    for cclearv_ip, shard in shards.items():
+        shard_plan = plan(shard, registries[cclearv_ip], complete_inventory)
+        plans[cclearv_ip] = shard_plan._replace(
+            remove=[d for d in shard_plan.remove if d.ip not in inventory_ips],
+            moved=[d for d in shard_plan.remove if d.ip in inventory_ips],
+        )
+    return plans
+
+
+# Keeps at most `max_changes` registrations and repairs, registrations first.
+# Returns the plan and the number of cVu-Vs left out.
+def limit(cvuv_plan: Plan, max_changes: int) -> typing.Tuple[Plan, int]:
+    register = cvuv_plan.register[: max(max_changes, 0)]
+    repair = cvuv_plan.repair[: max(max_changes - len(register), 0)]
+    deferred = (
+        len(cvuv_plan.register) + len(cvuv_plan.repair) - len(register) - len(repair)
+    )
+    return cvuv_plan._replace(register=register, repair=repair), deferred
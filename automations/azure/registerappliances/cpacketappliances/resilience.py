@@ -0,0 +1,117 @@
+import logging
+import random
+import threading
+import time
+import typing
+import urllib.parse
+
+from . import telemetry
+from .settings import get_env_float, get_env_int
+
+# Attempts made for a request that is safe to repeat; 1 disables retries.
+retry_attempts = get_env_int("HTTP_RETRY_ATTEMPTS", 3)
+# Seconds before the first retry. Each further retry doubles it, up to the
+# maximum, and the actual delay is drawn uniformly below that ("full jitter") so
+# concurrent workers do not retry in lockstep.
+retry_backoff = get_env_float("HTTP_RETRY_BACKOFF", 0.5)
+retry_backoff_max = get_env_float("HTTP_RETRY_BACKOFF_MAX", 8.0)
+# Consecutive failed requests after which a host is considered down, and seconds
+# before a single request is let through to test whether it has recovered.
+# A threshold of 0 disables the circuit breaker.
+breaker_threshold = get_env_int("HTTP_CIRCUIT_BREAKER_THRESHOLD", 5)
+breaker_reset = get_env_float("HTTP_CIRCUIT_BREAKER_RESET", 30.0)
+
+idempotent_methods = frozenset(["GET", "HEAD", "OPTIONS", "PUT", "DELETE"])
+# Statuses worth retrying: the request was not processed, or the server is
+# having a transient problem.
+retryable_statuses = frozenset([408, 429, 500, 502, 503, 504])
+# Of those, the ones that say the host itself is unhealthy. A 429 means it is
+# up, just busy.
+failure_statuses = frozenset([408, 500, 502, 503, 504])
+
+retry_delay = "cpacket.http.retry_delay"
+circuit_events = "cpacket.http.circuit"
+
+
+def backoff(attempt: int) -> float:
+    return random.uniform(0, min(retry_backoff_max, retry_backoff * 2**attempt))
+
+
+def sleep_before_retry(attempt: int, endpoint: str, reason: str) -> None:
+    delay = backoff(attempt)
+    telemetry.observe(retry_delay, delay * 1000, endpoint=endpoint, reason=reason)
+    time.sleep(delay)
+
+
+closed = "closed"
+open_ = "open"
+half_open = "half-open"
+
+
+# Stops requests to a host after `breaker_threshold` consecutive failures.
+# After `breaker_reset` seconds one request is let through: if it succeeds the
+# host is used again, otherwise the breaker stays open for another period.
+class CircuitBreaker:
+    def __init__(self, host: str):
+        self.host = host
+        self.state = closed
+        self.failures = 0
+        self.opened = 0.0
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        if breaker_threshold <= 0:
+            return True
+        with self.lock:
+            if self.state == closed:
+                return True
+            if self.state == open_ and time.monotonic() - self.opened >= breaker_reset:
+                self.state = half_open
+                logging.info(
+                    f"circuit for {self.host} half-open: sending a trial request"
+                )
+                return True
+        return False
+
+    def record_success(self) -> None:
+        with self.lock:
+            if self.state != closed:
+                logging.info(f"circuit for {self.host} closed: host recovered")
+                telemetry.observe(circuit_events, 1, event="closed")
+            self.state = closed
+            self.failures = 0
+
+    def record_failure(self) -> None:
+        if breaker_threshold <= 0:
+            return
+        with self.lock:
+            self.failures += 1
+            if self.state == half_open or (
+                self.state == closed and self.failures >= breaker_threshold
+            ):
+                logging.error(
+                    f"circuit for {self.host} open after {self.failures} consecutive failures: "
+                    f"failing requests for {breaker_reset:g}s"
+                )
+                telemetry.observe(circuit_events, 1, event="opened")
+                self.state = open_
+                self.opened = time.monotonic()
+
+
+_breakers: typing.Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker_for(url: str) -> CircuitBreaker:
+    host = urllib.parse.urlsplit(url).netloc
+    with _breakers_lock:
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = CircuitBreaker(host)
+            _breakers[host] = breaker
+    return breaker
+
+
+def rejected(url: str) -> None:
+    logging.error(f"not accessing {url}: circuit open, host is failing")
+    telemetry.observe(circuit_events, 1, event="rejected")
@@ -0,0 +1,104 @@
+import http.cookiejar
+import logging
+import threading
+import typing
+
+import requests
+import requests.adapters
+
+from .settings import get_env_int
+
+# Number of idle keep-alive connections kept per host. Should be at least the
+# number of concurrent registration workers, otherwise connections are dropped
+# and re-established.
+pool_maxsize = get_env_int("HTTP_POOL_MAXSIZE", 16)
+# Number of hosts whose connections each session keeps open. Beyond that, the
+# connections of the least recently used host are closed, so a worker that has
+# talked to many short-lived cVu-Vs does not keep a socket to each. Should be
+# at least the number of concurrent registration workers plus the cClear-Vs and
+# Azure endpoints in use.
+pool_connections = get_env_int("HTTP_POOL_CONNECTIONS", 32)
+
+# Sessions live for the lifetime of the worker process, so warm invocations
+# reuse the TCP connections (and the TLS sessions on them) opened by earlier
+# invocations. There is one per certificate verification mode, so a session
+# that skips verification is never used for a host that requires it; each
+# keeps a connection pool per host.
+_sessions: typing.Dict[bool, requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+# Requests sent and connections opened by the pools closed so far.
+_retired = {"requests": 0, "connections": 0}
+_retired_lock = threading.Lock()
+
+
+def get_session(verify: bool) -> requests.Session:
+    with _sessions_lock:
+        session = _sessions.get(verify)
+        if session is None:
+            session = new_session(verify)
+            _sessions[verify] = session
+    return session
+
+
+def new_session(verify: bool) -> requests.Session:
+    session = requests.Session()
+    session.verify = verify
+    # The session is shared by every thread and invocation of the worker, so it
+    # must not carry cookies set by one appliance's response into another call.
+    session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+    adapter = PoolAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# Closes the pool of a host evicted from the adapter's pool cache, which urllib3
+# 2 leaves to the garbage collector.
+class PoolAdapter(requests.adapters.HTTPAdapter):
+    def init_poolmanager(self, *args: typing.Any, **kwargs: typing.Any) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pools.dispose_func = retire_pool
+
+
+def retire_pool(pool: typing.Any) -> None:
+    with _retired_lock:
+        _retired["requests"] += pool.num_requests
+        _retired["connections"] += pool.num_connections
+    pool.close()
+
+
+def pool_stats() -> typing.Dict[str, int]:
+    # A hit is a request sent on an already open connection; a miss is a new
+    # connection (and, for HTTPS, a new TLS handshake).
+    with _retired_lock:
+        requests_sent = _retired["requests"]
+        connections_opened = _retired["connections"]
+    with _sessions_lock:
+        sessions = list(_sessions.values())
+    for session in sessions:
+        for adapter in set(session.adapters.values()):
+            if not isinstance(adapter, requests.adapters.HTTPAdapter):
+                continue
+            for pool_key in list(adapter.poolmanager.pools.keys()):
+                pool = adapter.poolmanager.pools.get(pool_key)
+                if pool is None:
+                    continue
+                requests_sent += pool.num_requests
+                connections_opened += pool.num_connections
+    return {
+        "hits": max(requests_sent - connections_opened, 0),
+        "misses": connections_opened,
+    }
+
+
+def log_pool_stats(before: typing.Dict[str, int]) -> None:
+    after = pool_stats()
+    hits = after["hits"] - before["hits"]
+    misses = after["misses"] - before["misses"]
+    if hits == 0 and misses == 0:
+        return
+    logging.info(
+        f"HTTP connection pool: {hits} hits, {misses} misses "
+        f"({after['hits']} hits, {after['misses']} misses since worker start)"
+    )
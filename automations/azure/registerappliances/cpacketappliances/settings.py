@@ -0,0 +1,24 @@
+import logging
+import os
+
+
+def get_env_int(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    if value is None or value == "":
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        logging.error(f"ignoring invalid value for {name}: {value}")
+        return default
+
+
+def get_env_float(name: str, default: float) -> float:
+    value = os.environ.get(name)
+    if value is None or value == "":
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        logging.error(f"ignoring invalid value for {name}: {value}")
+        return default
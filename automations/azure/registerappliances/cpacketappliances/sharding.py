@@ -0,0 +1,31 @@
+import bisect
+import hashlib
+import typing
+
+from .settings import get_env_int
+
+# Points each cClear-V gets on the hash ring. More points spread the cVu-Vs more
+# evenly between cClear-Vs.
+ring_points = get_env_int("CCLEARV_RING_POINTS", 100)
+
+
+def point(value: str) -> int:
+    return int.from_bytes(hashlib.sha1(value.encode("utf-8")).digest()[:8], "big")
+
+
+# Assigns each cVu-V to one of the cClear-Vs by consistent hashing: adding or
+# removing a cClear-V only moves the cVu-Vs between it and its neighbours on the
+# ring, about 1/N of them, instead of reshuffling every assignment.
+class Ring:
+    def __init__(self, members: typing.Iterable[str]):
+        points = sorted(
+            (point(f"{member}#{index}"), member)
+            for member in set(members)
+            for index in range(max(ring_points, 1))
+        )
+        self.points = [value for value, _ in points]
+        self.members = [member for _, member in points]
+
+    def owner(self, key: str) -> str:
+        index = bisect.bisect(self.points, point(key)) % len(self.points)
+        return self.members[index]
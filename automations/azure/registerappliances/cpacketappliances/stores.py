@@ -0,0 +1,64 @@
+import contextlib
+import os
+import sqlite3
+import tempfile
+import threading
+import typing
+
+# State kept between invocations (pending events, past sweeps, registration
+# checkpoints) has two backends, picked by an app setting: a SQLite file local
+# to the worker, or an Azure Storage table in the Function App's storage account
+# (`AzureWebJobsStorage`), shared by every instance. This module holds what the
+# backends of each kind of state have in common.
+
+T = typing.TypeVar("T")
+
+
+def sqlite_path(setting: str, file_name: str) -> str:
+    return os.environ.get(setting, os.path.join(tempfile.gettempdir(), file_name))
+
+
+class SqliteStore:
+    # `schema` creates the store's table if it does not exist. WAL lets
+    # concurrent writers in the same worker proceed without blocking readers.
+    def __init__(self, path: str, schema: str, wal: bool = False):
+        self.path = path
+        with self.connect() as connection:
+            if wal:
+                connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(schema)
+
+    # Opens a connection in autocommit mode, closed when the block exits.
+    def connect(self) -> typing.ContextManager[sqlite3.Connection]:
+        return contextlib.closing(
+            sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        )
+
+
+class TableStore:
+    def __init__(self, table_name: str):
+        import azure.core.exceptions
+        import azure.data.tables
+
+        self.table = azure.data.tables.TableClient.from_connection_string(
+            os.environ["AzureWebJobsStorage"], table_name
+        )
+        try:
+            self.table.create_table()
+        except azure.core.exceptions.ResourceExistsError:
+            pass
+
+
+# A store created on first use, so the Azure SDK is only imported by
+# invocations that need it.
+class Lazy(typing.Generic[T]):
+    def __init__(self, new: typing.Callable[[], T]):
+        self.new = new
+        self.store: typing.Optional[T] = None
+        self.lock = threading.Lock()
+
+    def get(self) -> T:
+        with self.lock:
+            if self.store is None:
+                self.store = self.new()
+            return self.store
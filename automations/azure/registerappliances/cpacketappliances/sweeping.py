@@ -0,0 +1,249 @@
+import abc
+import collections
+import concurrent.futures
+import logging
+import os
+import typing
+
+from . import stores
+from .settings import get_env_float, get_env_int
+
+# Scale sets reconciled per sweep, and cVu-Vs registered or repaired per scale
+# set. Whatever does not fit is left to the following sweeps.
+sweep_max_scale_sets = get_env_int("SWEEP_MAX_SCALE_SETS", 10)
+sweep_max_changes = get_env_int("SWEEP_MAX_CHANGES", 100)
+# Scale sets reconciled at the same time, in total and per subscription (each
+# subscription has its own ARM request budget).
+sweep_workers = get_env_int("SWEEP_WORKERS", 4)
+sweep_subscription_workers = get_env_int("SWEEP_SUBSCRIPTION_WORKERS", 2)
+# Seconds after which an unchanged scale set is reconciled anyway, to catch
+# drift on the cClear-V side. 0 only reconciles scale sets that changed.
+sweep_full_interval = get_env_float("SWEEP_FULL_INTERVAL", 6 * 3600.0)
+# Only scale sets with this tag ("name=value") are swept; empty sweeps every
+# scale set in a resource group with a cClear-V.
+sweep_scale_set_tag = os.environ.get("SWEEP_SCALE_SET_TAG", "")
+# Where the state of the last sweep is kept: "sqlite" (a file local to the
+# worker) or "table" (an Azure Storage table shared by every instance).
+sweep_store = os.environ.get("SWEEP_STORE", "sqlite")
+sweep_sqlite_path = stores.sqlite_path(
+    "SWEEP_SQLITE_PATH", "cpacketappliances-sweep.db"
+)
+sweep_table_name = os.environ.get("SWEEP_TABLE", "cpacketsweep")
+
+outcome_in_sync = "in-sync"
+outcome_incomplete = "incomplete"
+outcome_failed = "failed"
+
+# Provisioning states of a scale set with an operation in progress.
+busy_states = frozenset(["Creating", "Updating", "Deleting"])
+
+
+class ScaleSet(typing.NamedTuple):
+    id: str
+    name: str
+    resource_group: str
+    subscription_id: str
+    # Changes whenever the scale set is scaled, updated or recreated.
+    marker: str
+    provisioning_state: str
+
+
+class SweepState(typing.NamedTuple):
+    # The marker the scale set had when it was last fully reconciled, and when.
+    marker: str
+    reconciled: float
+
+
+def scale_set_key(scale_set: ScaleSet) -> str:
+    return scale_set.id.lower()
+
+
+class SweepStore(abc.ABC):
+    @abc.abstractmethod
+    def load(self) -> typing.Dict[str, SweepState]:
+        ...
+
+    @abc.abstractmethod
+    def save(self, key: str, state: SweepState) -> None:
+        ...
+
+
+class SqliteSweepStore(stores.SqliteStore, SweepStore):
+    def __init__(self, path: str):
+        super().__init__(
+            path,
+            "CREATE TABLE IF NOT EXISTS swept ("
+            "key TEXT PRIMARY KEY, marker TEXT NOT NULL, reconciled REAL NOT NULL)",
+        )
+
+    def load(self) -> typing.Dict[str, SweepState]:
+        with self.connect() as connection:
+            rows = connection.execute(
+                "SELECT key, marker, reconciled FROM swept"
+            ).fetchall()
+        return {key: SweepState(marker, reconciled) for key, marker, reconciled in rows}
+
+    def save(self, key: str, state: SweepState) -> None:
+        with self.connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO swept (key, marker, reconciled) "
+                "VALUES (?, ?, ?)",
+                (key, state.marker, state.reconciled),
+            )
+
+
+class TableSweepStore(stores.TableStore, SweepStore):
+    partition_key = "scale-set"
+
+    def load(self) -> typing.Dict[str, SweepState]:
+        return {
+            entity["key"]: SweepState(entity["marker"], entity["reconciled"])
+            for entity in self.table.query_entities(
+                f"PartitionKey eq '{self.partition_key}'"
+            )
+        }
+
+    def save(self, key: str, state: SweepState) -> None:
+        import azure.data.tables
+
+        # Resource IDs contain '/', which row keys may not.
+        self.table.upsert_entity(
+            {
+                "PartitionKey": self.partition_key,
+                "RowKey": key.replace("/", ":"),
+                "key": key,
+                "marker": state.marker,
+                "reconciled": state.reconciled,
+            },
+            mode=azure.data.tables.UpdateMode.REPLACE,
+        )
+
+
+def new_store() -> SweepStore:
+    if sweep_store == "table":
+        return TableSweepStore(sweep_table_name)
+    return SqliteSweepStore(sweep_sqlite_path)
+
+
+_store = stores.Lazy(new_store)
+
+
+def get_store() -> SweepStore:
+    return _store.get()
+
+
+def scale_set_tag() -> typing.Optional[typing.Tuple[str, str]]:
+    if sweep_scale_set_tag == "":
+        return None
+    name, _, value = sweep_scale_set_tag.partition("=")
+    return name, value
+
+
+# Picks the scale sets to reconcile: those that changed since they were last
+# reconciled (never reconciled first), then those not reconciled for
+# `sweep_full_interval`, oldest first, up to `sweep_max_scale_sets`. Scale sets
+# still being updated are left to the event their update will send.
+def select(
+    scale_sets: typing.List[ScaleSet],
+    states: typing.Dict[str, SweepState],
+    now: float,
+) -> typing.List[ScaleSet]:
+    changed: typing.List[typing.Tuple[float, ScaleSet]] = []
+    due: typing.List[typing.Tuple[float, ScaleSet]] = []
+    unchanged = 0
+    updating = 0
+    for scale_set in scale_sets:
+        if scale_set.provisioning_state in busy_states:
+            updating += 1
+            continue
+        state = states.get(scale_set_key(scale_set))
+        if state is None:
+            changed.append((0.0, scale_set))
+        elif state.marker != scale_set.marker:
+            changed.append((state.reconciled, scale_set))
+        elif sweep_full_interval > 0 and now - state.reconciled >= sweep_full_interval:
+            due.append((state.reconciled, scale_set))
+        else:
+            unchanged += 1
+
+    ordered = [
+        scale_set
+        for _, scale_set in sorted(changed, key=lambda item: item[0])
+        + sorted(due, key=lambda item: item[0])
+    ]
+    selected = ordered[: max(sweep_max_scale_sets, 0)]
+    logging.info(
+        f"sweep: {len(changed)} changed, {len(due)} due for a full reconcile, "
+        f"{unchanged} unchanged, {updating} being updated; "
+        f"reconciling {len(selected)}, deferring {len(ordered) - len(selected)}"
+    )
+    return selected
+
+
+def record(scale_set: ScaleSet, now: float) -> None:
+    get_store().save(scale_set_key(scale_set), SweepState(scale_set.marker, now))
+
+
+# Reconciles the scale sets with `work`, at most `sweep_workers` at a time and at
+# most `sweep_subscription_workers` per subscription. Scale sets are only handed
+# to a thread once their subscription has room, so threads never sit waiting
+# for one busy subscription while others could make progress. Returns the
+# outcome of each scale set, keyed by resource ID.
+def fan_out(
+    scale_sets: typing.List[ScaleSet], work: typing.Callable[[ScaleSet], str]
+) -> typing.Dict[str, str]:
+    queued: typing.Dict[str, typing.Deque[ScaleSet]] = collections.defaultdict(
+        collections.deque
+    )
+    for scale_set in scale_sets:
+        queued[scale_set.subscription_id.lower()].append(scale_set)
+    running: typing.Counter[str] = collections.Counter()
+    workers = max(sweep_workers, 1)
+    per_subscription = max(sweep_subscription_workers, 1)
+    outcomes: typing.Dict[str, str] = {}
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix="sweep"
+    ) as executor:
+        futures: typing.Dict[concurrent.futures.Future, ScaleSet] = {}
+
+        def submit_ready() -> None:
+            for subscription, queue in queued.items():
+                while (
+                    queue
+                    and running[subscription] < per_subscription
+                    and len(futures) < workers
+                ):
+                    scale_set = queue.popleft()
+                    running[subscription] += 1
+                    futures[executor.submit(work, scale_set)] = scale_set
+
+        submit_ready()
+        while futures:
+            done, _ = concurrent.futures.wait(
+                futures, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                scale_set = futures.pop(future)
+                running[scale_set.subscription_id.lower()] -= 1
+                outcomes[scale_set.id] = future.result()
+            submit_ready()
+
+    return outcomes
+
+
+def log_outcomes(
+    scale_sets: typing.List[ScaleSet], outcomes: typing.Dict[str, str]
+) -> None:
+    by_subscription: typing.Dict[str, typing.Counter[str]] = collections.defaultdict(
+        collections.Counter
+    )
+    for scale_set in scale_sets:
+        by_subscription[scale_set.subscription_id][outcomes[scale_set.id]] += 1
+    for subscription_id, counts in sorted(by_subscription.items()):
+        logging.info(
+            f"sweep of subscription {subscription_id}: "
+            + ", ".join(
+                f"{count} {outcome}" for outcome, count in sorted(counts.items())
+            )
+        )
@@ -0,0 +1,212 @@
+import abc
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+import typing
+import urllib.parse
+
+# Where metrics go: "none" (disabled), "log" (one JSON trace line per metric,
+# which Application Insights ingests with the function's logs) or "memory"
+# (kept in the process, for tests and benchmarks). Adaptive sampling applies to
+# the log sink's lines like any other trace, so aggregates over them are
+# estimates: a sampled-away line drops its count, sum and buckets.
+telemetry_sink = os.environ.get("TELEMETRY_SINK", "none")
+
+phase_duration = "cpacket.phase.duration"
+http_duration = "cpacket.http.duration"
+pipeline_duration = "cpacket.pipeline.duration"
+
+# Upper bounds, in milliseconds, of the histogram buckets. The last bucket
+# holds everything slower.
+bucket_bounds = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+
+# An aggregate of every value observed for one metric name and set of
+# dimensions since the last flush, in the shape of an Application Insights
+# custom metric (count, sum, min, max) plus bucket counts.
+class Metric(typing.NamedTuple):
+    name: str
+    dimensions: typing.Dict[str, str]
+    count: int
+    total: float
+    minimum: float
+    maximum: float
+    buckets: typing.List[int]
+
+
+class Sink(abc.ABC):
+    @abc.abstractmethod
+    def emit(self, metric: Metric) -> None:
+        ...
+
+
+class LogSink(Sink):
+    # Query with: traces | where message startswith "metric "
+    #             | extend metric = parse_json(substring(message, 7))
+    def emit(self, metric: Metric) -> None:
+        logging.info(
+            "metric %s",
+            json.dumps(
+                {
+                    "name": metric.name,
+                    "dimensions": metric.dimensions,
+                    "count": metric.count,
+                    "sum": round(metric.total, 3),
+                    "min": round(metric.minimum, 3),
+                    "max": round(metric.maximum, 3),
+                    "bucketBounds": bucket_bounds,
+                    "buckets": metric.buckets,
+                },
+                sort_keys=True,
+            ),
+        )
+
+
+class MemorySink(Sink):
+    def __init__(self):
+        self.metrics: typing.List[Metric] = []
+        self.lock = threading.Lock()
+
+    def emit(self, metric: Metric) -> None:
+        with self.lock:
+            self.metrics.append(metric)
+
+    def find(self, name: str, **dimensions: str) -> typing.List[Metric]:
+        with self.lock:
+            return [
+                metric
+                for metric in self.metrics
+                if metric.name == name
+                and all(metric.dimensions.get(k) == v for k, v in dimensions.items())
+            ]
+
+    def clear(self) -> None:
+        with self.lock:
+            self.metrics = []
+
+
+def new_sink(kind: str) -> typing.Optional[Sink]:
+    if kind == "log":
+        return LogSink()
+    if kind == "memory":
+        return MemorySink()
+    if kind != "none":
+        logging.error(f"unknown TELEMETRY_SINK {kind}: telemetry disabled")
+    return None
+
+
+_sink = new_sink(telemetry_sink)
+_histograms: typing.Dict[typing.Tuple[str, typing.Tuple], typing.List] = {}
+_histograms_lock = threading.Lock()
+
+
+def get_sink() -> typing.Optional[Sink]:
+    return _sink
+
+
+def set_sink(sink: typing.Optional[Sink]) -> None:
+    global _sink
+    _sink = sink
+
+
+def enabled() -> bool:
+    return _sink is not None
+
+
+# Adds a value (in milliseconds) to the histogram for the name and dimensions.
+def observe(name: str, value: float, **dimensions: str) -> None:
+    if _sink is None:
+        return
+    key = (name, tuple(sorted(dimensions.items())))
+    bucket = bisect.bisect_left(bucket_bounds, value)
+    with _histograms_lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            # count, sum, min, max, buckets
+            histogram = [0, 0.0, value, value, [0] * (len(bucket_bounds) + 1)]
+            _histograms[key] = histogram
+        histogram[0] += 1
+        histogram[1] += value
+        histogram[2] = min(histogram[2], value)
+        histogram[3] = max(histogram[3], value)
+        histogram[4][bucket] += 1
+
+
+# Emits every histogram observed since the last flush. Called once at the end
+# of each invocation, so the number of metrics sent does not grow with the fleet.
+def flush() -> None:
+    if _sink is None:
+        return
+    with _histograms_lock:
+        histograms = list(_histograms.items())
+        _histograms.clear()
+    for (name, dimensions), (count, total, minimum, maximum, buckets) in histograms:
+        _sink.emit(
+            Metric(name, dict(dimensions), count, total, minimum, maximum, buckets)
+        )
+
+
+class Span:
+    def __init__(self, name: str, dimensions: typing.Dict[str, str]):
+        self.name = name
+        self.dimensions = dimensions
+
+    # Adds dimensions only known once the span has started, such as a status.
+    def set(self, **dimensions: typing.Any) -> None:
+        self.dimensions.update({k: str(v) for k, v in dimensions.items()})
+
+    def __enter__(self) -> "Span":
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is not None:
+            self.dimensions.setdefault("error", exc_type.__name__)
+        observe(
+            self.name, (time.perf_counter() - self.started) * 1000, **self.dimensions
+        )
+
+
+class NullSpan:
+    def set(self, **dimensions: typing.Any) -> None:
+        pass
+
+    def __enter__(self) -> "NullSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        pass
+
+
+_null_span = NullSpan()
+
+
+# Times the enclosed block. With telemetry disabled this returns a shared no-op
+# span, so instrumented code costs a function call.
+def span(name: str, **dimensions: str) -> typing.Union[Span, NullSpan]:
+    if _sink is None:
+        return _null_span
+    return Span(name, dimensions)
+
+
+def phase(name: str) -> typing.Union[Span, NullSpan]:
+    return span(phase_duration, phase=name)
+
+
+def http_span(method: str, url: str) -> typing.Union[Span, NullSpan]:
+    if _sink is None:
+        return _null_span
+    return span(http_duration, method=method, endpoint=endpoint_name(url))
+
+
+# Appliance paths are fixed, but ARM paths carry subscription, resource group
+# and resource names: only the last segment is kept so the endpoint dimension
+# has a handful of values.
+def endpoint_name(url: str) -> str:
+    parsed = urllib.parse.urlsplit(url)
+    if parsed.hostname == "management.azure.com":
+        return f"arm:{parsed.path.rstrip('/').split('/')[-1]}"
+    return parsed.path
@@ -0,0 +1,204 @@
+import email.utils
+import logging
+import re
+import threading
+import time
+import typing
+import urllib.parse
+
+from . import telemetry
+from .settings import get_env_float, get_env_int
+
+if typing.TYPE_CHECKING:
+    import azure.core.pipeline
+    import azure.core.pipeline.policies
+
+# ARM allows each subscription and principal a budget of requests that refills
+# over time, and reports what is left in `x-ms-ratelimit-remaining-*` headers.
+# Each subscription is paced on its own, so a throttled subscription does not
+# hold up the others.
+# Below `reserve` remaining requests, calls are spaced out, up to `max_delay`
+# seconds apart as the budget approaches zero. 0 disables the pacing.
+arm_reserve = get_env_int("ARM_THROTTLE_RESERVE", 100)
+arm_max_delay = get_env_float("ARM_THROTTLE_MAX_DELAY", 5.0)
+# Seconds to pause a subscription's ARM calls after a 429 without a
+# Retry-After, and the longest Retry-After honored.
+arm_retry_after_default = get_env_float("ARM_RETRY_AFTER_DEFAULT", 10.0)
+arm_retry_after_max = get_env_float("ARM_RETRY_AFTER_MAX", 60.0)
+
+# The budget refills, so a remaining count older than this says little.
+quota_ttl = 60.0
+
+arm_hosts = frozenset(["management.azure.com"])
+subscription_path = re.compile(r"^/subscriptions/([^/]+)", re.IGNORECASE)
+throttle_wait = "cpacket.arm.throttle_wait"
+throttled = "cpacket.arm.throttled"
+
+remaining_header_prefix = "x-ms-ratelimit-remaining-"
+
+
+def remaining_quota(headers: typing.Mapping[str, str]) -> typing.Optional[int]:
+    # Most headers hold a number. Compute's `...-resource` header lists its
+    # policies instead: "Microsoft.Compute/HighCostGet3Min;107,...".
+    lowest = None
+    for name, value in headers.items():
+        if not name.lower().startswith(remaining_header_prefix):
+            continue
+        for count in re.findall(r"(?:^|[;,])\s*(\d+)\s*(?=,|$)", value):
+            if lowest is None or int(count) < lowest:
+                lowest = int(count)
+    return lowest
+
+
+def retry_after(headers: typing.Mapping[str, str]) -> typing.Optional[float]:
+    lowered = {name.lower(): value for name, value in headers.items()}
+    for name in ["retry-after-ms", "x-ms-retry-after-ms"]:
+        if name in lowered:
+            try:
+                return max(float(lowered[name]) / 1000, 0.0)
+            except ValueError:
+                pass
+    value = lowered.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        logging.warning(f"ignoring invalid Retry-After: {value}")
+        return None
+    return max(date.timestamp() - time.time(), 0.0)
+
+
+# One budget for the ARM calls the worker makes in a subscription, or outside
+# any (tenant-level calls such as Resource Graph queries), through the SDK
+# clients or our own sessions, shared by all threads.
+class Governor:
+    def __init__(self, name: str, subscription_id: str = ""):
+        self.name = name
+        self.subscription_id = subscription_id
+        self.remaining: typing.Optional[int] = None
+        self.observed = 0.0
+        self.next_allowed = 0.0
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def spacing(self, now: float) -> float:
+        if arm_reserve <= 0 or self.remaining is None:
+            return 0.0
+        if self.remaining >= arm_reserve or now - self.observed > quota_ttl:
+            return 0.0
+        return arm_max_delay * (1 - self.remaining / arm_reserve)
+
+    # Waits until the next request may be sent.
+    def acquire(self) -> None:
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_allowed, self.blocked_until)
+            self.next_allowed = start + self.spacing(now)
+        wait = start - now
+        if wait > 0:
+            telemetry.observe(
+                throttle_wait,
+                wait * 1000,
+                api=self.name,
+                subscription=self.subscription_id,
+            )
+            time.sleep(wait)
+
+    def observe(self, status: int, headers: typing.Mapping[str, str]) -> None:
+        remaining = remaining_quota(headers)
+        delay = None
+        if status in (429, 503):
+            # A 503 only pauses the budget when ARM says for how long.
+            delay = retry_after(headers)
+            if delay is None and status == 429:
+                delay = arm_retry_after_default
+            if delay is not None:
+                delay = min(delay, arm_retry_after_max)
+
+        with self.lock:
+            now = time.monotonic()
+            was_low = self.spacing(now) > 0
+            if remaining is not None:
+                self.remaining = remaining
+                self.observed = now
+            if delay is not None:
+                self.blocked_until = max(self.blocked_until, now + delay)
+
+        if delay is not None:
+            logging.warning(
+                f"{self.name} throttled with HTTP {status}: pausing {self.scope()} requests for {delay:g}s"
+            )
+            telemetry.observe(
+                throttled,
+                1,
+                api=self.name,
+                subscription=self.subscription_id,
+                status=status,
+            )
+        elif remaining is not None and remaining < arm_reserve and not was_low:
+            logging.info(
+                f"{self.name} request budget low for {self.scope()} ({remaining} left): slowing down"
+            )
+
+    def scope(self) -> str:
+        if self.subscription_id == "":
+            return "tenant"
+        return f"subscription {self.subscription_id}"
+
+
+tenant = Governor("arm")
+_subscriptions: typing.Dict[str, Governor] = {}
+_subscriptions_lock = threading.Lock()
+
+
+def subscription_governor(subscription_id: str) -> Governor:
+    subscription_id = subscription_id.lower()
+    with _subscriptions_lock:
+        governor = _subscriptions.get(subscription_id)
+        if governor is None:
+            governor = Governor("arm", subscription_id)
+            _subscriptions[subscription_id] = governor
+        return governor
+
+
+# Returns the governor for an ARM URL: its subscription's, or the tenant's for
+# calls outside a subscription. None for other hosts.
+def governor_for(url: str) -> typing.Optional[Governor]:
+    parts = urllib.parse.urlsplit(url)
+    if parts.hostname not in arm_hosts:
+        return None
+    match = subscription_path.match(parts.path)
+    if match is None:
+        return tenant
+    return subscription_governor(urllib.parse.unquote(match.group(1)))
+
+
+# Puts the SDK clients' requests through the same governor as our own. It goes
+# after the SDK's retry policy, so every retry is paced too.
+def arm_policy() -> "azure.core.pipeline.policies.SansIOHTTPPolicy":
+    import azure.core.pipeline.policies
+
+    class GovernorPolicy(azure.core.pipeline.policies.SansIOHTTPPolicy):
+        def on_request(self, request: "azure.core.pipeline.PipelineRequest") -> None:
+            request_governor(request).acquire()
+
+        def on_response(
+            self,
+            request: "azure.core.pipeline.PipelineRequest",
+            response: "azure.core.pipeline.PipelineResponse",
+        ) -> None:
+            http_response = response.http_response
+            request_governor(request).observe(
+                http_response.status_code, http_response.headers
+            )
+
+    return GovernorPolicy()
+
+
+def request_governor(request: "azure.core.pipeline.PipelineRequest") -> Governor:
+    return governor_for(request.http_request.url) or tenant
@@ -0,0 +1,80 @@
+import logging
+import threading
+import time
+import typing
+
+from .settings import get_env_float
+
+if typing.TYPE_CHECKING:
+    import azure.core.credentials
+
+# Scope of Azure Resource Manager tokens. The management SDK clients request
+# this scope too, so raw REST calls and SDK calls share one cached token.
+management_scope = "https://management.azure.com/.default"
+
+# Seconds before a token expires at which it is refreshed in the background.
+token_refresh_margin = get_env_float("AZURE_TOKEN_REFRESH_MARGIN", 300.0)
+
+
+# Wraps a credential, caching its tokens by scope. A token close to expiry is
+# still returned while a replacement is fetched on a background thread, so
+# only the first request for a scope (or one after the token has actually
+# expired) waits on IMDS.
+class CachingTokenCredential:
+    def __init__(self, credential: typing.Any):
+        self.credential = credential
+        self.tokens: typing.Dict[
+            typing.Tuple, "azure.core.credentials.AccessToken"
+        ] = {}
+        self.refreshing: typing.Set[typing.Tuple] = set()
+        self.lock = threading.Lock()
+
+    def get_token(
+        self, *scopes: str, **kwargs: typing.Any
+    ) -> "azure.core.credentials.AccessToken":
+        # Claims challenges (continuous access evaluation) need a fresh token.
+        if kwargs.get("claims"):
+            return self.credential.get_token(*scopes, **kwargs)
+
+        key = (scopes, kwargs.get("tenant_id"))
+        now = time.time()
+        with self.lock:
+            token = self.tokens.get(key)
+            if token is not None and token.expires_on > now:
+                if (
+                    token.expires_on - now <= token_refresh_margin
+                    and key not in self.refreshing
+                ):
+                    self.refreshing.add(key)
+                    threading.Thread(
+                        target=self.refresh,
+                        args=(key, scopes, kwargs),
+                        name="token-refresh",
+                        daemon=True,
+                    ).start()
+                return token
+
+        return self.fetch(key, scopes, kwargs)
+
+    def fetch(
+        self, key: typing.Tuple, scopes: typing.Tuple, kwargs: typing.Dict
+    ) -> "azure.core.credentials.AccessToken":
+        token = self.credential.get_token(*scopes, **kwargs)
+        with self.lock:
+            self.tokens[key] = token
+        return token
+
+    def refresh(
+        self, key: typing.Tuple, scopes: typing.Tuple, kwargs: typing.Dict
+    ) -> None:
+        try:
+            self.fetch(key, scopes, kwargs)
+        except Exception as e:
+            # The cached token is still valid; the next call retries.
+            logging.error(f"failed to refresh token for {scopes}: {e}")
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+    def close(self) -> None:
+        self.credential.close()
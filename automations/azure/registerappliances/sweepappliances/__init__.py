@@ -0,0 +1,9 @@
+import azure.functions as func
+
+from .. import cpacketappliances
+
+
+# Periodically reconciles the scale sets whose events may have been missed. The
+# work is done by the event-triggered function's code.
+def main(timer: func.TimerRequest, context: func.Context):
+    cpacketappliances.sweep_main(timer, context)